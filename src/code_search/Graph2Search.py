@@ -51,38 +51,35 @@ class Graph2Search(nn.Module):
         code_graphs = ex['code_graphs']
         doc_graphs = ex['doc_graphs']
         doc_words = ex['targets']
-        if self.message_function == 'edge_mm':
-            code_edge_vec = code_graphs['edge_features']
-            doc_edge_vec = doc_graphs['edge_features']
-        else:
-            code_edge_vec = self.edge_embed(code_graphs['edge_features'])
-            doc_edge_vec = self.edge_embed(doc_graphs['edge_features'])
-        code_node_mask = create_mask(code_graphs['node_num'], code_graphs['max_node_num_batch'], self.device)
-        doc_node_mask = create_mask(doc_graphs['node_num'], doc_graphs['max_node_num_batch'], self.device)
-
-        node_embedded = self.word_embed(code_graphs['node_index'])
-        node_embedded = dropout(node_embedded, self.word_dropout, shared_axes=[-2], training=self.training)
-        doc_words_embedded = self.word_embed(doc_words)
-        doc_words_embedded = dropout(doc_words_embedded, self.word_dropout, shared_axes=[-2], training=self.training)
-
+        # Only the branches selected by code_info_type / des_info_type are computed
         if self.code_info_type in ['all', 'local']:
+            code_edge_vec = code_graphs['edge_features'] if self.message_function == 'edge_mm' \
+                else self.edge_embed(code_graphs['edge_features'])
+            code_node_mask = create_mask(code_graphs['node_num'], code_graphs['max_node_num_batch'], self.device)
+            node_embedded = self.word_embed(code_graphs['node_index'])
+            node_embedded = dropout(node_embedded, self.word_dropout, shared_axes=[-2], training=self.training)
             code_node_embedding = self.code_graph_encoder(node_embedded, code_edge_vec,
                                                           (code_graphs['node2edge'], code_graphs['edge2node']))
             local_code_state = self.graph_maxpool(code_node_embedding, code_node_mask).squeeze()
+        doc_node_mask = create_mask(doc_graphs['node_num'], doc_graphs['max_node_num_batch'], self.device)
+        doc_words_embedded = self.word_embed(doc_words)
+        doc_words_embedded = dropout(doc_words_embedded, self.word_dropout, shared_axes=[-2], training=self.training)
         if self.des_info_type in ['all', 'local']:
+            doc_edge_vec = doc_graphs['edge_features'] if self.message_function == 'edge_mm' \
+                else self.edge_embed(doc_graphs['edge_features'])
             doc_node_embedding = self.sequence_graph_encoder(doc_words_embedded, doc_edge_vec,
                                                              (doc_graphs['node2edge'], doc_graphs['edge2node']))
             local_doc_state = self.graph_maxpool(doc_node_embedding, doc_node_mask).squeeze()
-        code_sequence_embedded = self.word_embed(ex['sequences'])
-        code_sequence_embedded_mask = create_mask(ex['sequence_lens'], ex['max_code_lens'], self.device)
-        doc_sequence_embedded_mask = create_mask(doc_graphs['node_num'], doc_graphs['max_node_num_batch'], self.device)
         if self.code_info_type in ['all', 'global']:
+            code_sequence_embedded = self.word_embed(ex['sequences'])
+            code_sequence_embedded_mask = create_mask(ex['sequence_lens'], ex['max_code_lens'], self.device)
             weighted_code = self.global_code_att(code_sequence_embedded, code_sequence_embedded, code_sequence_embedded,
                                                  code_sequence_embedded_mask.unsqueeze(1))
             global_code_state = torch.div(torch.sum(weighted_code, dim=1), ex['sequence_lens'].unsqueeze(1).float())
         if self.des_info_type in ['all', 'global']:
+            # Description nodes are its words, so the sequence mask is the node mask
             weighted_doc = self.global_sequence_att(doc_words_embedded, doc_words_embedded, doc_words_embedded,
-                                                    doc_sequence_embedded_mask.unsqueeze(1))
+                                                    doc_node_mask.unsqueeze(1))
             global_doc_state = torch.div(torch.sum(weighted_doc, dim=1), ex['target_lens'].unsqueeze(1).float())
         if self.code_info_type in ['all']:
             src_state = torch.cat([local_code_state, global_code_state], dim=-1)
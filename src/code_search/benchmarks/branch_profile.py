@@ -0,0 +1,78 @@
+"""
+Time per embedding branch (GGNN 'local' vs attention 'global', code and query side) and test MRR.
+
+Run from src/code_search with one or more configs, each with a trained 'pretrained' model and 'testset':
+    python benchmarks/branch_profile.py --config config/search_python.yml other_model.yml --batches 20
+Every model is timed on all four branches, so the table shows what each code_info_type /
+des_info_type combination costs; 'code' and 'query' are the time of the branches the
+model's own config selects, i.e. what cal_code_features / cal_query_features run.
+"""
+import argparse
+import copy
+import os
+import sys
+import torch
+import yaml
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from encoders import CodeEncoder, QueryEncoder
+from model_handler_extend import ModelHandlerExtend
+from utils.data_utils import vectorize_input
+from benchmarks.quantization_report import timed
+
+
+def profile(config, num_batches, repeats):
+    model_handle = ModelHandlerExtend(config)
+    metrics = model_handle.test()
+    loader = model_handle.test_loader
+    loader.reset()
+    batches = []
+    for _ in range(min(num_batches, loader.get_num_batch())):
+        batches.append(vectorize_input(loader.nextBatch(), training=False, device=model_handle.device, mode='test'))
+    network = model_handle.model.network
+    network.train(False)
+    code_encoder, query_encoder = CodeEncoder.from_network(network), QueryEncoder.from_network(network)
+    num_examples = sum(ex['batch_size'] for ex in batches)
+    times = {}
+    with torch.no_grad():
+        for name, fn in [('code local', code_encoder.local_state), ('code global', code_encoder.global_state),
+                         ('query local', lambda ex: query_encoder.local_state(ex, *query_encoder.embed_words(ex))),
+                         ('query global', lambda ex: query_encoder.global_state(ex, *query_encoder.embed_words(ex))),
+                         ('code', code_encoder), ('query', query_encoder)]:
+            times[name] = timed(fn, batches, repeats) / num_examples * 1000
+    return metrics, times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, nargs='+', required=True)
+    parser.add_argument('--batches', type=int, default=20, help='test batches to time')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--cpu', action='store_true', help='time on CPU even when CUDA is available')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    rows = []
+    for config_file in args.config:
+        with open(config_file) as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+        if args.cpu:
+            config['no_cuda'] = True
+        if config['out_dir'] is not None:
+            config['pretrained'] = config['out_dir']
+            config['out_dir'] = None
+        metrics, times = profile(copy.deepcopy(config), args.batches, args.repeats)
+        rows.append((config_file, config['code_info_type'], config['des_info_type'], metrics, times))
+
+    columns = ['code local', 'code global', 'query local', 'query global', 'code', 'query']
+    print('\nms per example')
+    print('{:24s} {:>6s} {:>6s} {:>8s} '.format('config', 'code', 'query', 'MRR') +
+          ' '.join('{:>12s}'.format(column) for column in columns))
+    for config_file, code_info_type, des_info_type, metrics, times in rows:
+        print('{:24s} {:>6s} {:>6s} {:8.5f} '.format(config_file, code_info_type, des_info_type, metrics['MRR']) +
+              ' '.join('{:12.4f}'.format(times[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Throughput of description graph building: one NLP call per description vs `build_desc_graphs`.
+
+Run from src/code_search:
+    python benchmarks/desc_graph_throughput.py --input graph_train_gnn.jsonl.gz --num 20000
+Without --input a synthetic set of descriptions is used. The batched graphs are
+checked against the per-call ones before any throughput is reported.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from graph_gen.build_java_graph import build_desc_graph, build_desc_graphs
+
+
+WORDS = ['returns', 'the', 'number', 'of', 'elements', 'in', 'this', 'list', 'read', 'file', 'and', 'parse',
+         'json', 'create', 'a', 'new', 'instance', 'from', 'given', 'string', 'value', 'check', 'if', 'user',
+         'is', 'valid', 'convert', 'to', 'lower', 'case', 'get', 'http', 'request', 'headers', 'sort', 'array']
+
+
+def load_descs(path, num):
+    descs = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            tokens = json.loads(line).get('docstring_tokens')
+            if tokens:
+                desc = ' '.join(re.sub(r'[^A-Za-z0-9 ]+', ' ', ' '.join(tokens)).split())
+                if desc:
+                    descs.append(desc)
+            if len(descs) >= num:
+                break
+    return descs
+
+
+def synthetic_descs(num, seed=2020):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 30))) for _ in range(num)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default=None, help='jsonl.gz file with docstring_tokens')
+    parser.add_argument('--num', type=int, default=5000, help='number of descriptions')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--n-process', type=int, default=1)
+    args = parser.parse_args()
+
+    descs = load_descs(args.input, args.num) if args.input else synthetic_descs(args.num)
+    print('{} descriptions, {:.1f} tokens on average'.format(len(descs),
+                                                              sum(len(d.split()) for d in descs) / len(descs)))
+
+    start = time.perf_counter()
+    single = [build_desc_graph(desc) for desc in descs]
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = build_desc_graphs(descs, batch_size=args.batch_size, n_process=args.n_process)
+    batched_time = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(single, batched))
+    if mismatches:
+        raise SystemExit('{} of {} graphs differ between per-call and batched parsing'.format(mismatches, len(descs)))
+    print('per call : {:8.1f} desc/s ({:.2f}s)'.format(len(descs) / single_time, single_time))
+    print('batched  : {:8.1f} desc/s ({:.2f}s, batch_size={}, n_process={})'.format(
+        len(descs) / batched_time, batched_time, args.batch_size, args.n_process))
+    print('speedup  : {:.2f}x'.format(single_time / batched_time))
+
+
+if __name__ == '__main__':
+    main()
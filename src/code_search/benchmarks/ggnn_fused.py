@@ -0,0 +1,75 @@
+"""
+Benchmark of the GGNN hops with the original vs the fused GRUStep / GatedFusion ('fused_ggnn').
+
+Run from src/code_search:
+    python benchmarks/ggnn_fused.py --batch-size 200 --hidden-size 128 --graph-hops 3
+Times GraphNN.static_graph_update on code-sized and query-sized graphs, for inference and
+for forward + backward. The fused network gets the original weights through
+convert_ggnn_state_dict, and its outputs are checked against the original ones first.
+"""
+import argparse
+import os
+import sys
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import convert_ggnn_state_dict
+from graphs import GraphNN
+from benchmarks.edge_message_passing import random_incidence, timed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--graph-hops', type=int, default=3)
+    parser.add_argument('--graph-direction', type=str, default='all')
+    parser.add_argument('--code-nodes', type=int, default=150, help='padded nodes of a code graph batch')
+    parser.add_argument('--code-edges', type=int, default=300, help='padded edges of a code graph batch')
+    parser.add_argument('--query-nodes', type=int, default=12, help='padded nodes of a query graph batch')
+    parser.add_argument('--query-edges', type=int, default=11, help='padded edges of a query graph batch')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+
+    networks = {}
+    for fused in [False, True]:
+        config = {'device': device, 'graph_hidden_size': args.hidden_size, 'graph_direction': args.graph_direction,
+                  'graph_type': 'ggnn_bi', 'graph_hops': args.graph_hops, 'word_dropout': 0.,
+                  'message_function': 'no_edge', 'fused_ggnn': fused}
+        networks[fused] = GraphNN(config).to(device)
+    networks[True].load_state_dict(convert_ggnn_state_dict(networks[False].state_dict(), True))
+
+    for name, num_nodes, num_edges in [('code', args.code_nodes, args.code_edges),
+                                       ('query', args.query_nodes, args.query_edges)]:
+        node_feature = torch.randn(args.batch_size, num_nodes, args.hidden_size, device=device)
+        adj = random_incidence(args.batch_size, num_edges, num_nodes, int(num_edges * 0.8), device)
+        results = {}
+        for fused, network in networks.items():
+            parameters = [p for n, p in network.named_parameters() if n.startswith('static_')]
+
+            def inference():
+                with torch.no_grad():
+                    return network(node_feature, None, adj)
+
+            def training():
+                out = network(node_feature, None, adj)
+                torch.autograd.grad(out.sum(), parameters)
+
+            results[fused] = (inference(), timed(inference, args.repeats, device), timed(training, args.repeats, device))
+        (out, inference_time, training_time), (fused_out, fused_inference_time, fused_training_time) = \
+            results[False], results[True]
+        if not torch.allclose(out, fused_out, rtol=1e-4, atol=1e-4):
+            raise SystemExit('{}: the fused GGNN does not match the original one'.format(name))
+        print('{:6s} {:>4d} x {:>4d} nodes x {:>4d} edges'.format(name, args.batch_size, num_nodes, num_edges))
+        for mode, seconds, fused_seconds in [('inference', inference_time, fused_inference_time),
+                                             ('training', training_time, fused_training_time)]:
+            print('  {:10s} original {:9.2f} ms  fused {:9.2f} ms  {:6.2f}x'.format(
+                mode, seconds * 1000, fused_seconds * 1000, seconds / fused_seconds))
+
+
+if __name__ == '__main__':
+    main()
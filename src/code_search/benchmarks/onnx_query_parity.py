@@ -0,0 +1,118 @@
+"""
+Parity and latency of the ONNX query encoder (onnxruntime, CPU) against cal_query_features.
+
+Run from src/code_search, with 'pretrained' and 'testset' set in the config:
+    python benchmarks/onnx_query_parity.py --config config/search_python.yml --batches 20
+The query encoder of the pretrained model is exported to a temporary query_encoder.onnx
+(or read from --onnx), and both embed the same test batches. Both are also checked to
+embed a query the same alone as in a padded batch with other queries. Exits non-zero
+when the largest absolute difference of either check is above --atol.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+import yaml
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from encoders import QUERY_ONNX_FILE, QueryEncoder, export_query_onnx
+from model import cal_query_features
+from model_handler_extend import ModelHandlerExtend
+from utils.data_utils import Batch, DataStream, data_reader_settings, read_all_Datasets, vectorize_input
+from utils.onnx_query_encoder import OnnxQueryEncoder
+
+
+def timed(fn, batches, repeats):
+    for batch in batches[:1]:
+        fn(batch)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for batch in batches:
+            fn(batch)
+    return (time.perf_counter() - start) / repeats
+
+
+def embed_batch(network, onnx_encoder, instances, config, vocab_model, device):
+    batch = Batch(instances, config, vocab_model.word_vocab, vocab_model.edge_vocab)
+    with torch.no_grad():
+        torch_vectors = cal_query_features(network, vectorize_input(batch, training=False, device=device, mode='test'))
+    arrays = dict(batch.doc_graph_arrays, targets=batch.sent2_word, target_lens=batch.sent2_length)
+    return torch_vectors, onnx_encoder(arrays)
+
+
+def batching_diff(network, onnx_encoder, instances, config, vocab_model, device):
+    """Largest difference between the rows of one padded batch of `instances` and each instance embedded alone."""
+    batched = embed_batch(network, onnx_encoder, instances, config, vocab_model, device)
+    max_diff = 0.
+    for i, instance in enumerate(instances):
+        single = embed_batch(network, onnx_encoder, [instance], config, vocab_model, device)
+        for vectors, single_vectors in zip(batched, single):
+            max_diff = max(max_diff, float(np.abs(vectors[i] - single_vectors[0]).max()))
+    return max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--onnx', type=str, default=None, help='query_encoder.onnx to check instead of a fresh export')
+    parser.add_argument('--batches', type=int, default=20, help='test batches to compare')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='torch and onnxruntime intra-op threads')
+    parser.add_argument('--batch-check', type=int, default=16, help='queries embedded alone and batched together')
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config['no_cuda'] = True
+    config['quantize_int8'] = False
+    if config['out_dir'] is not None:
+        config['pretrained'] = config['out_dir']
+        config['out_dir'] = None
+
+    model_handle = ModelHandlerExtend(config)
+    network = model_handle.model.network
+    network.train(False)
+    onnx_file = args.onnx
+    if onnx_file is None:
+        onnx_file = os.path.join(tempfile.mkdtemp(), QUERY_ONNX_FILE)
+        export_query_onnx(QueryEncoder.from_network(network), onnx_file)
+    onnx_encoder = OnnxQueryEncoder(onnx_file, num_threads=args.threads or 0)
+
+    vocab_model = model_handle.model.vocab_model
+    test_set, _, _ = read_all_Datasets(config['testset'], isLower=True, **data_reader_settings(config))
+    loader = DataStream(test_set, vocab_model.word_vocab, vocab_model.edge_vocab, config=config,
+                        isShuffle=False, isLoop=False, isSort=True, batch_size=config['test_batch_size'])
+    batches = []
+    for _ in range(min(args.batches, loader.get_num_batch())):
+        batch = loader.nextBatch()
+        arrays = dict(batch.doc_graph_arrays, targets=batch.sent2_word, target_lens=batch.sent2_length)
+        batches.append((vectorize_input(batch, training=False, device=model_handle.device, mode='test'), arrays))
+
+    max_diff = 0.
+    for ex, arrays in batches:
+        with torch.no_grad():
+            expected = cal_query_features(network, ex)
+        max_diff = max(max_diff, float(np.abs(onnx_encoder(arrays) - expected).max()))
+    with torch.no_grad():
+        torch_time = timed(lambda batch: cal_query_features(network, batch[0]), batches, args.repeats)
+    onnx_time = timed(lambda batch: onnx_encoder(batch[1]), batches, args.repeats)
+    num_examples = sum(ex['batch_size'] for ex, _ in batches)
+    batch_diff = batching_diff(network, onnx_encoder, test_set[:args.batch_check], config, vocab_model,
+                               model_handle.device)
+
+    print('\nmax abs diff vs cal_query_features: {:.3g} over {} queries'.format(max_diff, num_examples))
+    print('max abs diff alone vs batched: {:.3g} over {} queries'.format(batch_diff, min(args.batch_check, len(test_set))))
+    print('{:10s} {:>12s}'.format('backend', 'ms/query'))
+    print('{:10s} {:12.4f}'.format('torch', torch_time / num_examples * 1000))
+    print('{:10s} {:12.4f}'.format('onnx', onnx_time / num_examples * 1000))
+    if max(max_diff, batch_diff) > args.atol:
+        print('FAILED: difference above atol={}'.format(args.atol))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
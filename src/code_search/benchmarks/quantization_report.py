@@ -0,0 +1,80 @@
+"""
+Accuracy and latency of the float model vs dynamic int8 quantization ('quantize_int8') on CPU.
+
+Run from src/code_search, with 'pretrained' and 'testset' set in the config:
+    python benchmarks/quantization_report.py --config config/search_python.yml --batches 20
+Accuracy is MRR / NDCG on the test set via ModelHandlerExtend.test; latency is the
+time to embed the test batches with the code and the query encoder.
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+import torch
+import yaml
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model import cal_code_features, cal_query_features
+from model_handler_extend import ModelHandlerExtend
+from utils.data_utils import vectorize_input
+
+
+def timed(fn, batches, repeats):
+    for ex in batches[:1]:
+        fn(ex)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for ex in batches:
+            fn(ex)
+    return (time.perf_counter() - start) / repeats
+
+
+def evaluate(config, num_batches, repeats):
+    model_handle = ModelHandlerExtend(config)
+    metrics = model_handle.test()
+    loader = model_handle.test_loader
+    loader.reset()
+    batches = []
+    for _ in range(min(num_batches, loader.get_num_batch())):
+        batches.append(vectorize_input(loader.nextBatch(), training=False, device=model_handle.device, mode='test'))
+    network = model_handle.model.network
+    with torch.no_grad():
+        code_time = timed(lambda ex: cal_code_features(network, ex), batches, repeats)
+        query_time = timed(lambda ex: cal_query_features(network, ex), batches, repeats)
+    num_examples = sum(ex['batch_size'] for ex in batches)
+    return metrics, code_time / num_examples, query_time / num_examples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--batches', type=int, default=20, help='test batches to time')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config['no_cuda'] = True
+    if config['out_dir'] is not None:
+        config['pretrained'] = config['out_dir']
+        config['out_dir'] = None
+
+    results = {}
+    for name, quantize in [('float', False), ('int8', True)]:
+        results[name] = evaluate(dict(copy.deepcopy(config), quantize_int8=quantize), args.batches, args.repeats)
+
+    (float_metrics, float_code, float_query), (int8_metrics, int8_code, int8_query) = results['float'], results['int8']
+    print('\n{:10s} {:>10s} {:>10s} {:>10s}'.format('metric', 'float', 'int8', 'delta'))
+    for k in float_metrics:
+        print('{:10s} {:10.5f} {:10.5f} {:+10.5f}'.format(k, float_metrics[k], int8_metrics[k],
+                                                          int8_metrics[k] - float_metrics[k]))
+    print('\n{:10s} {:>12s} {:>12s} {:>8s}'.format('encoder', 'float ms/ex', 'int8 ms/ex', 'speedup'))
+    for side, float_time, int8_time in [('code', float_code, int8_code), ('query', float_query, int8_query)]:
+        print('{:10s} {:12.4f} {:12.4f} {:7.2f}x'.format(side, float_time * 1000, int8_time * 1000,
+                                                          float_time / int8_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,67 @@ class GRUStep(nn.Module):
         return h_state
 
 
+class FusedGatedFusion(nn.Module):
+    def __init__(self, hidden_size):
+        super(FusedGatedFusion, self).__init__()
+        '''GatedFusion with fc_z folded onto [h, x, h * x], since
+        W1 h + W2 x + W3 (h * x) + W4 (h - x) = (W1 + W4) h + (W2 - W4) x + W3 (h * x)'''
+        self.fc_gate = nn.Linear(3 * hidden_size, hidden_size, bias=True)
+
+    def forward(self, h_state, input):
+        z = torch.sigmoid(self.fc_gate(torch.cat([h_state, input, h_state * input], -1)))
+        # (1 - z) * h_state + z * input, written over z when no gradient is needed
+        return torch.lerp(h_state, input, z) if torch.is_grad_enabled() else torch.lerp(h_state, input, z, out=z)
+
+
+class FusedGRUStep(nn.Module):
+    def __init__(self, hidden_size, input_size):
+        super(FusedGRUStep, self).__init__()
+        '''GRUStep with one concatenation: z and r come from one stacked matmul, and
+        linear_t is split into its h_state (linear_th) and input (linear_tx) columns'''
+        self.linear_zr = nn.Linear(hidden_size + input_size, 2 * hidden_size, bias=False)
+        self.linear_th = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.linear_tx = nn.Linear(input_size, hidden_size, bias=False)
+
+    def forward(self, h_state, input):
+        z, r = torch.sigmoid(self.linear_zr(torch.cat([h_state, input], -1))).chunk(2, dim=-1)
+        t = self.linear_th(r * h_state).add_(self.linear_tx(input)).tanh_()
+        # (1 - z) * h_state + z * t, written over t when no gradient is needed
+        return torch.lerp(h_state, t, z) if torch.is_grad_enabled() else torch.lerp(h_state, t, z, out=t)
+
+
+def convert_ggnn_state_dict(state_dict, fused):
+    '''Copy of `state_dict` with the GRUStep / GatedFusion weights in the fused layout (or, with
+    fused=False, the original one), so a checkpoint of either layout loads into both'''
+    state_dict = dict(state_dict)
+    for key in list(state_dict):
+        if fused and key.endswith('linear_z.weight'):
+            prefix = key[:-len('linear_z.weight')]
+            weight_t = state_dict.pop(prefix + 'linear_t.weight')
+            hidden_size = weight_t.size(0)
+            state_dict[prefix + 'linear_zr.weight'] = torch.cat([state_dict.pop(key),
+                                                                 state_dict.pop(prefix + 'linear_r.weight')], 0)
+            state_dict[prefix + 'linear_th.weight'] = weight_t[:, :hidden_size].clone()
+            state_dict[prefix + 'linear_tx.weight'] = weight_t[:, hidden_size:].clone()
+        elif fused and key.endswith('fc_z.weight'):
+            prefix = key[:-len('fc_z.weight')]
+            w_h, w_x, w_hx, w_diff = state_dict.pop(key).chunk(4, dim=1)
+            state_dict[prefix + 'fc_gate.weight'] = torch.cat([w_h + w_diff, w_x - w_diff, w_hx], 1)
+            state_dict[prefix + 'fc_gate.bias'] = state_dict.pop(prefix + 'fc_z.bias')
+        elif not fused and key.endswith('linear_zr.weight'):
+            prefix = key[:-len('linear_zr.weight')]
+            state_dict[prefix + 'linear_z.weight'], state_dict[prefix + 'linear_r.weight'] = \
+                [w.clone() for w in state_dict.pop(key).chunk(2, dim=0)]
+            state_dict[prefix + 'linear_t.weight'] = torch.cat([state_dict.pop(prefix + 'linear_th.weight'),
+                                                                state_dict.pop(prefix + 'linear_tx.weight')], 1)
+        elif not fused and key.endswith('fc_gate.weight'):
+            prefix = key[:-len('fc_gate.weight')]
+            w_h, w_x, w_hx = state_dict.pop(key).chunk(3, dim=1)
+            state_dict[prefix + 'fc_z.weight'] = torch.cat([w_h, w_x, w_hx, torch.zeros_like(w_h)], 1)
+            state_dict[prefix + 'fc_z.bias'] = state_dict.pop(prefix + 'fc_gate.bias')
+    return state_dict
+
+
 def dropout(x, drop_prob, shared_axes=[], training=False):
     """
     Apply dropout to input tensor.
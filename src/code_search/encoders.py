@@ -0,0 +1,272 @@
+"""
+Inference-only code and query encoders of Graph2Search.
+
+`export_encoders` writes a trained model as a directory of separate artifacts:
+
+    encoders.json       model config the encoders are rebuilt from
+    code_encoder.pt     state_dict of the CodeEncoder, without the word embeddings
+    query_encoder.pt    state_dict of the QueryEncoder, without the word embeddings
+    vocab/              word and edge vocabs (VocabModel.save) with the trained word embeddings
+
+`load_encoder` rebuilds one side only: no optimizer, criterion or other encoder is
+created, and the word embeddings are memory-mapped from vocab/.
+
+`quantize_dynamic_int8` is the CPU inference mode selected by config 'quantize_int8'.
+
+`export_query_onnx` writes the query encoder as query_encoder.onnx, which
+utils.onnx_query_encoder runs with onnxruntime (config 'query_encoder_backend: onnx').
+"""
+import os
+import copy
+import json
+import torch
+import torch.nn as nn
+from attention import MultiHeadedAttention
+from common import convert_ggnn_state_dict, dropout
+from graphs import GraphNN
+from utils.data_utils import BatchIncidence
+from utils.generic_utils import create_mask
+from utils.onnx_query_encoder import ONNX_INPUTS
+from utils.vocab_utils import VocabModel
+
+
+ENCODER_FORMAT_VERSION = 1
+ENCODER_CONFIG_FILE = 'encoders.json'
+CODE_ENCODER_FILE = 'code_encoder.pt'
+QUERY_ENCODER_FILE = 'query_encoder.pt'
+QUERY_ONNX_FILE = 'query_encoder.onnx'
+VOCAB_DIR = 'vocab'
+
+
+def graph_maxpool(linear_max, node_state, node_mask):
+    node_state = node_state * node_mask.unsqueeze(-1).float()
+    # Max over the nodes; same as max_pool1d over the whole node axis, but with no fixed kernel size
+    return torch.amax(linear_max(node_state), dim=-2)
+
+
+class SideEncoder(nn.Module):
+    """One side of Graph2Search: word and edge embeddings, a GraphNN and global attention.
+
+    Subclasses name the Graph2Search modules they take over in `from_network`.
+    """
+    graph_encoder_name = None
+    global_att_name = None
+    info_type_name = None
+
+    def __init__(self, config, word_embed, edge_embed, graph_encoder, global_att, linear_max):
+        super(SideEncoder, self).__init__()
+        self.device = config['device']
+        self.word_dropout = config['word_dropout']
+        self.message_function = config['message_function']
+        self.info_type = config[self.info_type_name]
+        self.word_embed = word_embed
+        self.edge_embed = edge_embed
+        self.graph_encoder = graph_encoder
+        self.global_att = global_att
+        self.linear_max = linear_max
+
+    @classmethod
+    def build(cls, config, word_embed):
+        """New encoder with freshly initialized modules, e.g. to load an exported state_dict into."""
+        hidden_size = config['graph_hidden_size']
+        return cls(config, word_embed,
+                   nn.Embedding(config['num_edge_types'], config['edge_embed_dim'], padding_idx=0),
+                   GraphNN(config),
+                   MultiHeadedAttention(config.get('heads', 4), hidden_size, config, config['word_dropout']),
+                   nn.Linear(hidden_size, hidden_size, bias=False))
+
+    @classmethod
+    def from_network(cls, network):
+        """Encoder sharing the modules (and so the weights) of a Graph2Search network."""
+        config = {'device': network.device, 'word_dropout': network.word_dropout,
+                  'message_function': network.message_function,
+                  'code_info_type': network.code_info_type, 'des_info_type': network.des_info_type}
+        encoder = cls(config, network.word_embed, network.edge_embed, getattr(network, cls.graph_encoder_name),
+                      getattr(network, cls.global_att_name), network.linear_max)
+        return encoder.train(network.training)
+
+    def edge_vec(self, graphs):
+        if self.message_function == 'edge_mm':
+            return graphs['edge_features']
+        return self.edge_embed(graphs['edge_features'])
+
+    def forward(self, ex):
+        # Only the branches selected by code_info_type / des_info_type are computed
+        local_state = self.local_state(ex) if self.info_type in ['all', 'local'] else None
+        global_state = self.global_state(ex) if self.info_type in ['all', 'global'] else None
+        return self.combine(local_state, global_state)
+
+    def combine(self, local_state, global_state):
+        if self.info_type in ['all']:
+            return torch.cat([local_state, global_state], dim=-1)
+        elif self.info_type in ['global']:
+            return global_state
+        return local_state
+
+
+class CodeEncoder(SideEncoder):
+    """Code graph and code token sequence -> code vector."""
+    graph_encoder_name = 'code_graph_encoder'
+    global_att_name = 'global_code_att'
+    info_type_name = 'code_info_type'
+
+    def local_state(self, ex):
+        """GGNN over the code graph, max-pooled over its nodes."""
+        code_graphs = ex['code_graphs']
+        code_node_mask = create_mask(code_graphs['node_num'], code_graphs['max_node_num_batch'], self.device)
+        node_embedded = self.word_embed(code_graphs['node_index'])
+        node_embedded = dropout(node_embedded, self.word_dropout, shared_axes=[-2], training=self.training)
+        code_node_embedding = self.graph_encoder(node_embedded, self.edge_vec(code_graphs),
+                                                 (code_graphs['node2edge'], code_graphs['edge2node']))
+        return graph_maxpool(self.linear_max, code_node_embedding, code_node_mask)
+
+    def global_state(self, ex):
+        """Self-attention over the code token sequence, averaged over its tokens."""
+        code_sequence_embedded = self.word_embed(ex['sequences'])
+        code_sequence_embedded_mask = create_mask(ex['sequence_lens'], ex['max_code_lens'], self.device)
+        weighted_code = self.global_att(code_sequence_embedded, code_sequence_embedded, code_sequence_embedded,
+                                        code_sequence_embedded_mask.unsqueeze(1))
+        return torch.div(torch.sum(weighted_code, dim=1), ex['sequence_lens'].unsqueeze(1).float())
+
+
+class QueryEncoder(SideEncoder):
+    """Description (query) graph -> query vector."""
+    graph_encoder_name = 'sequence_graph_encoder'
+    global_att_name = 'global_sequence_att'
+    info_type_name = 'des_info_type'
+
+    def forward(self, ex):
+        # Both branches read the node mask and the word embeddings, so they are computed once
+        doc_node_mask, doc_words_embedded = self.embed_words(ex)
+        local_state = self.local_state(ex, doc_node_mask, doc_words_embedded) \
+            if self.info_type in ['all', 'local'] else None
+        global_state = self.global_state(ex, doc_node_mask, doc_words_embedded) \
+            if self.info_type in ['all', 'global'] else None
+        return self.combine(local_state, global_state)
+
+    def embed_words(self, ex):
+        """Node mask and word embeddings of the description; its nodes are its words."""
+        doc_graphs = ex['doc_graphs']
+        doc_node_mask = create_mask(doc_graphs['node_num'], doc_graphs['max_node_num_batch'], self.device)
+        return doc_node_mask, self.word_embed(ex['targets'])
+
+    def local_state(self, ex, doc_node_mask, doc_words_embedded):
+        """GGNN over the description graph, max-pooled over its nodes."""
+        doc_graphs = ex['doc_graphs']
+        doc_node_embedding = self.graph_encoder(doc_words_embedded, self.edge_vec(doc_graphs),
+                                                (doc_graphs['node2edge'], doc_graphs['edge2node']))
+        # Padded nodes are left out of the max, so a query embeds the same alone or in a padded batch
+        doc_node_state = self.linear_max(doc_node_embedding)
+        doc_node_state = doc_node_state.masked_fill(doc_node_mask.unsqueeze(-1) == 0, float('-inf'))
+        return torch.amax(doc_node_state, dim=-2)
+
+    def global_state(self, ex, doc_node_mask, doc_words_embedded):
+        """Self-attention over the description words, averaged over its words."""
+        weighted_doc = self.global_att(doc_words_embedded, doc_words_embedded, doc_words_embedded,
+                                       doc_node_mask.unsqueeze(1))
+        # Padded positions still get attention outputs; they are not part of the average
+        weighted_doc = weighted_doc * doc_node_mask.unsqueeze(-1)
+        return torch.div(torch.sum(weighted_doc, dim=1), ex['target_lens'].unsqueeze(1).float())
+
+
+class QueryEncoderGraph(nn.Module):
+    """QueryEncoder over plain tensors (the ONNX_INPUTS), the form it is exported to ONNX in."""
+    def __init__(self, query_encoder):
+        super(QueryEncoderGraph, self).__init__()
+        self.query_encoder = query_encoder
+
+    def forward(self, targets, target_lens, edge_features, edge_ids, src_ids, dst_ids):
+        batch_size, num_nodes = targets.shape
+        num_edges = edge_features.size(1)
+        doc_graphs = {'edge_features': edge_features,
+                      'node2edge': BatchIncidence(edge_ids, dst_ids, (batch_size, num_edges, num_nodes)),
+                      'edge2node': BatchIncidence(src_ids, edge_ids, (batch_size, num_nodes, num_edges)),
+                      'node_num': target_lens,
+                      'max_node_num_batch': num_nodes}
+        return self.query_encoder({'doc_graphs': doc_graphs, 'targets': targets, 'target_lens': target_lens})
+
+
+def export_query_onnx(query_encoder, path):
+    """Writes `query_encoder` to `path` as ONNX, with dynamic batch, node and edge axes."""
+    encoder = copy.deepcopy(query_encoder).cpu().train(False).requires_grad_(False)
+    encoder.device = torch.device('cpu')
+    if hasattr(encoder.graph_encoder, 'static_graph_mp'):
+        # 'grouped' exports with one matmul per edge type; 'batched' would gather a hidden_size^2 matrix per edge
+        encoder.graph_encoder.static_graph_mp.edge_message_mode = 'grouped'
+    # Example batch: 2 queries of 5 and 3 words, with 3 and 1 edges
+    num_nodes, num_edges = 5, 3
+    example = (torch.randint(1, encoder.word_embed.num_embeddings, (2, num_nodes)),
+               torch.LongTensor([5, 3]),
+               torch.randint(1, encoder.edge_embed.num_embeddings, (2, num_edges)),
+               torch.LongTensor([0, 1, 2, num_edges]),
+               torch.LongTensor([0, 1, 2, num_nodes]),
+               torch.LongTensor([1, 2, 3, num_nodes + 1]))
+    batch, nodes, edges, incidences = [torch.export.Dim(name) for name in ('batch', 'nodes', 'edges', 'incidences')]
+    dynamic_shapes = {'targets': {0: batch, 1: nodes}, 'target_lens': {0: batch},
+                      'edge_features': {0: batch, 1: edges},
+                      'edge_ids': {0: incidences}, 'src_ids': {0: incidences}, 'dst_ids': {0: incidences}}
+    with torch.no_grad():
+        torch.onnx.export(QueryEncoderGraph(encoder).train(False), example, path, input_names=list(ONNX_INPUTS),
+                          output_names=['query_vectors'], dynamic_shapes=dynamic_shapes, dynamo=True,
+                          external_data=False)
+
+
+def quantize_dynamic_int8(module):
+    """Swaps every nn.Linear of `module` (GRUStep, GatedFusion, MultiHeadedAttention.linears,
+    linear_max, ...) in place for a dynamically quantized int8 one, for CPU inference only.
+    Embeddings and the edge weight tensors stay float."""
+    return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+ENCODERS = {'code': (CodeEncoder, CODE_ENCODER_FILE),
+            'query': (QueryEncoder, QUERY_ENCODER_FILE)}
+
+
+def inference_device(config):
+    if not config['no_cuda'] and torch.cuda.is_available():
+        return torch.device('cuda' if config['cuda_id'] < 0 else 'cuda:%d' % config['cuda_id'])
+    return torch.device('cpu')
+
+
+def export_encoders(model, outdir, onnx=False):
+    """Writes the code and query encoders of a trained `model.Model` to `outdir`, plus query_encoder.onnx if `onnx`."""
+    network = model.network
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    # The vocabs with the trained (rather than the initial) word embeddings
+    vocab_model = copy.copy(model.vocab_model)
+    vocab_model.word_vocab = copy.copy(model.vocab_model.word_vocab)
+    vocab_model.word_vocab.embeddings = network.word_embed.weight.detach().cpu().numpy()
+    vocab_model.save(os.path.join(outdir, VOCAB_DIR))
+    for side, (encoder_class, filename) in ENCODERS.items():
+        state_dict = encoder_class.from_network(network).state_dict()
+        state_dict = {name: value.cpu() for name, value in state_dict.items() if not name.startswith('word_embed.')}
+        torch.save(state_dict, os.path.join(outdir, filename))
+    config = {key: value for key, value in model.config.items()
+              if key != 'device' and isinstance(value, (str, int, float, bool, list, type(None)))}
+    with open(os.path.join(outdir, ENCODER_CONFIG_FILE), 'w') as f:
+        json.dump({'version': ENCODER_FORMAT_VERSION, 'config': config}, f, indent=1)
+    if onnx:
+        export_query_onnx(QueryEncoder.from_network(network), os.path.join(outdir, QUERY_ONNX_FILE))
+
+
+def load_encoder(export_dir, side, device=None):
+    """Returns the `side` ('code' or 'query') encoder of an export directory, in eval mode, and its VocabModel."""
+    with open(os.path.join(export_dir, ENCODER_CONFIG_FILE)) as f:
+        saved = json.load(f)
+    if saved['version'] != ENCODER_FORMAT_VERSION:
+        raise RuntimeError('Unsupported encoder format version {} in {}'.format(saved['version'], export_dir))
+    config = dict(saved['config'], device=device)
+    vocab_model = VocabModel.load(os.path.join(export_dir, VOCAB_DIR))
+    embeddings = torch.from_numpy(vocab_model.word_vocab.embeddings)
+    word_embed = nn.Embedding(embeddings.size(0), embeddings.size(1), padding_idx=0, _weight=embeddings)
+    encoder_class, filename = ENCODERS[side]
+    encoder = encoder_class.build(config, word_embed)
+    state_dict = torch.load(os.path.join(export_dir, filename), map_location='cpu', weights_only=True)
+    state_dict = convert_ggnn_state_dict(state_dict, config.get('fused_ggnn', True))
+    missing, unexpected = encoder.load_state_dict(state_dict, strict=False)
+    if unexpected or missing != ['word_embed.weight']:
+        raise RuntimeError('{} does not match the {} encoder: missing {}, unexpected {}'.format(
+            filename, side, missing, unexpected))
+    encoder.requires_grad_(False)
+    return encoder.train(False).to(device), vocab_model
@@ -0,0 +1,29 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from utils.constants import INF
+
+
+class GraphAttentionLayer(nn.Module):
+    """Batched graph attention coefficients (Velickovic et al., 2018) over a padded batch.
+
+    Every node attends to its neighbours in `adj` and to itself, so padded nodes
+    only attend to themselves and never receive attention from real nodes.
+    """
+    def __init__(self, in_features, out_features, dropout, alpha):
+        super(GraphAttentionLayer, self).__init__()
+        self.dropout = dropout
+        self.W = nn.Linear(in_features, out_features, bias=False)
+        self.a_src = nn.Linear(out_features, 1, bias=False)
+        self.a_dst = nn.Linear(out_features, 1, bias=False)
+        self.leakyrelu = nn.LeakyReLU(alpha)
+
+    def forward(self, h, adj):
+        "h: batch_size x num_nodes x in_features, adj: batch_size x num_nodes x num_nodes"
+        Wh = self.W(h)
+        # e[b, i, j] = LeakyReLU(a^T [Wh_i || Wh_j])
+        e = self.leakyrelu(self.a_src(Wh) + self.a_dst(Wh).transpose(1, 2))
+        eye = torch.eye(adj.size(1), dtype=torch.bool, device=adj.device).unsqueeze(0)
+        e = e.masked_fill(~((adj > 0) | eye), -INF)
+        attention = F.softmax(e, dim=-1)
+        return F.dropout(attention, self.dropout, training=self.training)
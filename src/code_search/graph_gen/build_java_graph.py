@@ -6,7 +6,8 @@ import json
 from subprocess import Popen, PIPE
 from tqdm import tqdm
 import networkx as nx
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 from spacy.tokens import Doc
 import multiprocess as mp
 import pickle
@@ -297,10 +298,12 @@ def subtokenizer(identifier):
     return subtoken_list
 
 
-def single_post_process(key, chunk):
+def single_post_process(key, chunk, batch_size=1024, n_process=1):
     file_graph_name = os.path.join(os.path.join(RAW_FILE, key), 'graph_' + key + '_gnn.jsonl.gz')
     count = 0
     with gzip.GzipFile(file_graph_name, 'wb') as gnn_file:
+        # Samples are buffered so their descriptions are parsed batch_size at a time
+        samples = []
         for file in tqdm(chunk, desc="Single Post Process"):
             class_name = file.split('_')[1]
             if os.path.exists(os.path.join(RAW_FILE, key, 'java_funcs', file, class_name + '.java.json')):
@@ -312,24 +315,16 @@ def single_post_process(key, chunk):
                     with open(os.path.join(RAW_FILE, key, 'java_funcs', file, class_name + '.json')) as reader:
                         raw_sample = json.load(reader)
                     raw_sample['code_graph'] = normalize_graph(graph, sub_graph_nodes)
-                    if raw_sample['docstring_tokens']:
-                        doc_summary = ' '.join(re.sub(r'[^A-Za-z0-9 ]+', ' ',
-                                                      ' '.join(raw_sample['docstring_tokens'])).split())
-                        if doc_summary:
-                            doc_graph = build_desc_graph(doc_summary)
-                            if doc_graph:
-                                raw_sample['doc_graph'] = normalize_des_graph(doc_graph)
-                            else:
-                                continue
-                    else:
-                        raw_sample['doc_graph'] = {}
-                    if raw_sample['code_graph'] and raw_sample['doc_graph']:
-                        save_sample_to_jsonl_gz(raw_sample, gnn_file)
-                        count += 1
-                    del raw_sample
+                    if raw_sample['code_graph']:
+                        samples.append(raw_sample)
                 except:
                     continue
+            if len(samples) >= batch_size:
+                count += save_samples_with_desc_graphs(samples, gnn_file, batch_size=batch_size, n_process=n_process)
+                samples = []
+        count += save_samples_with_desc_graphs(samples, gnn_file, batch_size=batch_size, n_process=n_process)
         print('there are %d samples have code graph and doc graph in %s' % (count, key))
+        print('description graph cache: {}'.format(DESC_GRAPH_CACHE.stats()))
         gnn_file.close()
 
 
@@ -350,39 +345,81 @@ def post_process():
     # single_post_process('test', chunk_files['test'])
 
 
+# Only the dependency parse is read from a description; tagger, lemmatizer and ner can be skipped
+DESC_GRAPH_PIPES = ('tok2vec', 'parser')
+
+
+def clean_desc(desc):
+    if str(desc).endswith('.'):
+        desc = desc[0: len(desc)-1]
+    return ' '.join(desc.split())
+
+
+def doc_to_desc_graph(doc):
+    g_features = []
+    dep_tree = defaultdict(list)
+    boundary_nodes = []
+    for sent in doc.sents:
+        boundary_nodes.append(sent[-1].i)
+        for each in sent:
+            g_features.append(each.text)
+            if each.i != each.head.i:                   # Not a root
+                dep_tree[each.head.i].append({'node': each.i, 'edge': each.dep_})
+
+    for i in range(len(boundary_nodes) - 1):
+        # Add connection between neighboring dependency trees
+        dep_tree[boundary_nodes[i]].append({'node': boundary_nodes[i] + 1, 'edge': 'neigh'})
+        dep_tree[boundary_nodes[i] + 1].append({'node': boundary_nodes[i], 'edge': 'neigh'})
+    edges = []
+    for key, values in dep_tree.items():
+        for value in values:
+            edges.append((value['edge'], key, value['node']))
+    if edges:
+        des_graph = {'backbone_sequence': g_features, 'edges': edges}
+    else:
+        des_graph = {}
+    return des_graph
+
+
 def build_desc_graph(desc, file=None):
     try:
-        if str(desc).endswith('.'):
-            desc = desc[0: len(desc)-1]
-        desc = ' '.join(desc.split())
-        doc = NLP(desc)
-        g_features = []
-        dep_tree = defaultdict(list)
-        boundary_nodes = []
-        for sent in doc.sents:
-            boundary_nodes.append(sent[-1].i)
-            for each in sent:
-                g_features.append(each.text)
-                if each.i != each.head.i:                   # Not a root
-                    dep_tree[each.head.i].append({'node': each.i, 'edge': each.dep_})
-
-        for i in range(len(boundary_nodes) - 1):
-            # Add connection between neighboring dependency trees
-            dep_tree[boundary_nodes[i]].append({'node': boundary_nodes[i] + 1, 'edge': 'neigh'})
-            dep_tree[boundary_nodes[i] + 1].append({'node': boundary_nodes[i], 'edge': 'neigh'})
-        edges = []
-        for key, values in dep_tree.items():
-            for value in values:
-                edges.append((value['edge'], key, value['node']))
-        if edges:
-            des_graph = {'backbone_sequence': g_features, 'edges': edges}
-        else:
-            des_graph = {}
+        doc = NLP(clean_desc(desc))
+        des_graph = doc_to_desc_graph(doc)
     except:
         des_graph = {}
     return des_graph
 
 
+def build_desc_graphs(descs, batch_size=256, n_process=1):
+    """Batched `build_desc_graph`: parses every description with one `NLP.pipe` stream.
+
+    Returns the same graphs as `[build_desc_graph(desc) for desc in descs]`.
+    """
+    des_graphs = [{} for _ in descs]
+    texts = []
+    positions = []
+    for index, desc in enumerate(descs):
+        try:
+            texts.append(clean_desc(desc))
+            positions.append(index)
+        except:
+            continue
+    disable = [name for name in NLP.pipe_names if name not in DESC_GRAPH_PIPES]
+    done = 0
+    try:
+        for doc in NLP.pipe(texts, batch_size=batch_size, n_process=n_process, disable=disable):
+            try:
+                des_graphs[positions[done]] = doc_to_desc_graph(doc)
+            except:
+                pass
+            done += 1
+    except:
+        # A description the pipeline rejects aborts the stream, parse the rest one by one
+        for index in positions[done:]:
+            des_graphs[index] = build_desc_graph(descs[index])
+    return des_graphs
+
+
 def normalize_des_graph(des_graph):
     new_tokens = []
     new_edges = []
@@ -414,6 +451,122 @@ def normalize_des_graph(des_graph):
     return {'backbone_sequence': new_tokens, 'edges': new_edges}
 
 
+class DescGraphCache(object):
+    """Bounded LRU cache of normalized description graphs.
+
+    Keys are the description text after the same whitespace and trailing-period
+    clean-up `build_desc_graph` applies, so equivalent spellings share one spaCy parse.
+    Descriptions that produce no graph are cached too (as {}). Thread safe.
+    """
+    def __init__(self, maxsize=100000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def normalize_key(desc):
+        desc = str(desc)
+        if desc.endswith('.'):
+            desc = desc[0: len(desc)-1]
+        return ' '.join(desc.split())
+
+    def get(self, desc):
+        """Returns the cached normalized graph, or None on a miss."""
+        key = self.normalize_key(desc)
+        with self._lock:
+            if key in self._graphs:
+                self._graphs.move_to_end(key)
+                self.hits += 1
+                return self._graphs[key]
+            self.misses += 1
+            return None
+
+    def put(self, desc, graph):
+        key = self.normalize_key(desc)
+        with self._lock:
+            self._graphs[key] = graph
+            self._graphs.move_to_end(key)
+            while len(self._graphs) > self.maxsize:
+                self._graphs.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._graphs),
+                'hit_rate': self.hits / total if total else 0.}
+
+    def save(self, path=None):
+        path = path or self.path
+        with self._lock:
+            graphs = list(self._graphs.items())
+        with open(path, 'wb') as f:
+            pickle.dump(graphs, f)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            graphs = pickle.load(f)
+        with self._lock:
+            for key, graph in graphs[-self.maxsize:]:
+                self._graphs[key] = graph
+
+
+DESC_GRAPH_CACHE = DescGraphCache()
+
+
+def build_normalized_desc_graph(desc, cache=DESC_GRAPH_CACHE):
+    """normalize_des_graph(build_desc_graph(desc)) through `cache`; {} when desc yields no graph."""
+    if cache is not None:
+        des_graph = cache.get(desc)
+        if des_graph is not None:
+            return des_graph
+    des_graph = build_desc_graph(desc)
+    if des_graph:
+        des_graph = normalize_des_graph(des_graph)
+    if cache is not None:
+        cache.put(desc, des_graph)
+    return des_graph
+
+
+def build_normalized_desc_graphs(descs, batch_size=256, n_process=1, cache=DESC_GRAPH_CACHE):
+    """Batched `build_normalized_desc_graph`: only the cache misses go through `build_desc_graphs`."""
+    des_graphs = [cache.get(desc) if cache is not None else None for desc in descs]
+    missing = [index for index, des_graph in enumerate(des_graphs) if des_graph is None]
+    parsed = build_desc_graphs([descs[index] for index in missing], batch_size=batch_size, n_process=n_process)
+    for index, des_graph in zip(missing, parsed):
+        if des_graph:
+            des_graph = normalize_des_graph(des_graph)
+        des_graphs[index] = des_graph
+        if cache is not None:
+            cache.put(descs[index], des_graph)
+    return des_graphs
+
+
+def desc_summary(sample):
+    if not sample.get('docstring_tokens'):
+        return ''
+    return ' '.join(re.sub(r'[^A-Za-z0-9 ]+', ' ', ' '.join(sample['docstring_tokens'])).split())
+
+
+def save_samples_with_desc_graphs(samples, out_file, batch_size=256, n_process=1):
+    """Builds the description graphs of `samples` in one batch and writes out the samples
+    that have both a code graph and a description graph. Returns the number written."""
+    summaries = [desc_summary(sample) for sample in samples]
+    with_summary = [index for index, summary in enumerate(summaries) if summary]
+    doc_graphs = build_normalized_desc_graphs([summaries[index] for index in with_summary],
+                                              batch_size=batch_size, n_process=n_process)
+    count = 0
+    for index, doc_graph in zip(with_summary, doc_graphs):
+        if samples[index]['code_graph'] and doc_graph:
+            samples[index]['doc_graph'] = doc_graph
+            save_sample_to_jsonl_gz(samples[index], out_file)
+            count += 1
+    return count
+
+
 def clip_dot_graph(dot_file_path):
     nx_g = nx.drawing.nx_agraph.read_dot(dot_file_path)
     method_node_id = 0
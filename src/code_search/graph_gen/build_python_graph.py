@@ -34,10 +34,12 @@ def post_process():
         process.join()
 
 
-def single_post_process(key, chunk):
+def single_post_process(key, chunk, batch_size=1024, n_process=1):
     file_graph_name = os.path.join(os.path.join(RAW_FILE, key), 'graph_' + key + '_gnn.jsonl.gz')
     count = 0
     with gzip.GzipFile(file_graph_name, 'wb') as gnn_file:
+        # Samples are buffered so their descriptions are parsed batch_size at a time
+        samples = []
         for raw_sample in tqdm(chunk):
             try:
                 graph = build_python_graph(raw_sample['code'])
@@ -45,21 +47,16 @@ def single_post_process(key, chunk):
                     raw_sample['code_graph'] = normalize_graph(graph)
                 else:
                     continue
-                if raw_sample['docstring_tokens']:
-                    doc_summary = ' '.join(re.sub(r'[^A-Za-z0-9 ]+', ' ',
-                                                  ' '.join(raw_sample['docstring_tokens'])).split())
-                    if doc_summary:
-                        doc_graph = build_desc_graph(doc_summary)
-                        raw_sample['doc_graph'] = normalize_des_graph(doc_graph)
-                else:
-                    raw_sample['doc_graph'] = {}
-                if raw_sample['code_graph'] and raw_sample['doc_graph']:
-                    save_sample_to_jsonl_gz(raw_sample, gnn_file)
-                    count += 1
-                del raw_sample
+                if raw_sample['code_graph']:
+                    samples.append(raw_sample)
             except:
                 continue
+            if len(samples) >= batch_size:
+                count += save_samples_with_desc_graphs(samples, gnn_file, batch_size=batch_size, n_process=n_process)
+                samples = []
+        count += save_samples_with_desc_graphs(samples, gnn_file, batch_size=batch_size, n_process=n_process)
         print('there are %d samples have code graph and doc graph in %s' % (count, key))
+        print('description graph cache: {}'.format(DESC_GRAPH_CACHE.stats()))
         gnn_file.close()
 
 
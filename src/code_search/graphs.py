@@ -1,7 +1,9 @@
 import torch
 import torch.nn as nn
 from utils.generic_utils import to_cuda
-from common import GRUStep, GatedFusion
+from utils.data_utils import BatchIncidence
+from common import GRUStep, GatedFusion, FusedGRUStep, FusedGatedFusion
+from gat import GraphAttentionLayer
 import torch.nn.functional as F
 # from .GAT import GAT, GraphAttentionLayer
 from torch_geometric.nn.models import GAT
@@ -9,6 +11,28 @@ from torch_geometric.nn.models import GAT
 from torch_geometric.nn.models import GCN
 
 
+def graph_bmm(adj, x):
+    '''torch.bmm that also accepts a sparse BatchIncidence as the first operand'''
+    if isinstance(adj, BatchIncidence):
+        return adj.bmm(x)
+    return torch.bmm(adj, x)
+
+
+def dense_adjacency(node2edge, edge2node):
+    '''(batch_size, num_nodes, num_nodes) edge counts, adj[b, src, dst] = edge2node @ node2edge'''
+    if not isinstance(node2edge, BatchIncidence):
+        return torch.bmm(edge2node, node2edge)
+    batch_size, num_edges, num_nodes = node2edge.shape
+    # Both incidences hold every real edge once; look up its source and destination by edge id
+    src = node2edge.row_ids.new_zeros(batch_size * num_edges).index_copy(0, edge2node.col_ids, edge2node.row_ids)
+    dst = node2edge.row_ids.new_zeros(batch_size * num_edges).index_copy(0, node2edge.row_ids, node2edge.col_ids)
+    edge_ids = node2edge.row_ids
+    adj = torch.zeros(batch_size * num_nodes * num_nodes, device=edge_ids.device)
+    adj = adj.index_add(0, src[edge_ids] * num_nodes + dst[edge_ids] % num_nodes,
+                        torch.ones(edge_ids.size(0), device=edge_ids.device))
+    return adj.view(batch_size, num_nodes, num_nodes)
+
+
 class GraphNN(nn.Module):
     def __init__(self, config):
         super(GraphNN, self).__init__()
@@ -20,12 +44,14 @@ class GraphNN(nn.Module):
         self.graph_type = config['graph_type']
         self.graph_hops = config['graph_hops']
         self.word_dropout = config['word_dropout']
+        self.sparse_message_passing = config.get('sparse_message_passing', True)
         self.linear_max = nn.Linear(hidden_size, hidden_size, bias=False)
         if self.graph_type == 'ggnn_bi':
             self.static_graph_mp = GraphMessagePassing(config)
-            self.static_gru_step = GRUStep(hidden_size, hidden_size)
+            fused = config.get('fused_ggnn', True)
+            self.static_gru_step = (FusedGRUStep if fused else GRUStep)(hidden_size, hidden_size)
             if self.graph_direction == 'all':
-                self.static_gated_fusion = GatedFusion(hidden_size)
+                self.static_gated_fusion = (FusedGatedFusion if fused else GatedFusion)(hidden_size)
             self.graph_update = self.static_graph_update
         elif self.graph_type == 'gcn':
             self.gcn = GCN(config)
@@ -45,11 +71,11 @@ class GraphNN(nn.Module):
 
     def static_graph_update(self, node_feature, edge_vec, adj):
         '''Static graph update'''
+        # Shapes: (batch_size, num_edges, num_nodes) and (batch_size, num_nodes, num_edges)
         node2edge, edge2node = adj
-        # Shape: (batch_size, num_edges, num_nodes)
-        node2edge = to_cuda(torch.stack([torch.Tensor(x.A) for x in node2edge], dim=0), self.device)
-        # Shape: (batch_size, num_nodes, num_edges)
-        edge2node = to_cuda(torch.stack([torch.Tensor(x.A) for x in edge2node], dim=0), self.device)
+        if not self.sparse_message_passing:
+            node2edge = to_cuda(node2edge.to_dense(), self.device)
+            edge2node = to_cuda(edge2node.to_dense(), self.device)
         for _ in range(self.graph_hops):
             bw_agg_state = self.static_graph_mp.mp_func(node_feature, edge_vec, node2edge, edge2node)  # (num_nodes, dim)
             fw_agg_state = self.static_graph_mp.mp_func(node_feature, edge_vec, edge2node.transpose(1, 2), node2edge.transpose(1, 2))
@@ -63,18 +89,15 @@ class GraphNN(nn.Module):
         return node_feature
 
     def graph_attention_update(self, node_state, edge_vec, adj, node_mask=None):
-        node2edge, edge2node = adj
-        node2edge = to_cuda(torch.stack([torch.Tensor(x.A) for x in node2edge], dim=0), self.device)
-        edge2node = to_cuda(torch.stack([torch.Tensor(x.A) for x in edge2node], dim=0), self.device)
-        adj = torch.bmm(edge2node, node2edge)
-        node_weight_list = []
-        for index in range(node_state.size(0)):
-            current_node_state = node_state[index, :, :]
-            current = adj[index, :, :]
-            node_weight_index = self.gat(current_node_state, current)
-            node_weight_list.append(node_weight_index)
-        node_weight = torch.stack(node_weight_list)
-        node_state = torch.bmm(node_weight, node_state)
+        # Masked dense attention over the whole padded batch at once
+        adj = dense_adjacency(*adj)
+        if self.graph_direction == 'all':
+            adj = adj + adj.transpose(1, 2)
+        elif self.graph_direction == 'forward':
+            adj = adj.transpose(1, 2)
+        for _ in range(self.graph_hops):
+            node_weight = self.gat(node_state, adj)
+            node_state = torch.bmm(node_weight, node_state)
         return node_state
 
     def graph_gcn_update(self, node_state, edge_vec, adj, node_mask=None):
@@ -87,6 +110,9 @@ class GraphMessagePassing(nn.Module):
         super(GraphMessagePassing, self).__init__()
         self.config = config
         hidden_size = config['graph_hidden_size']
+        self.edge_message_mode = config.get('edge_message_mode', 'grouped')
+        if self.edge_message_mode not in ('loop', 'batched', 'grouped'):
+            raise RuntimeError('Unknown edge_message_mode: {}'.format(self.edge_message_mode))
         if config['message_function'] == 'edge_mm':
             self.edge_weight_tensor = torch.Tensor(config['num_edge_types'], hidden_size * hidden_size)
             self.edge_weight_tensor = nn.Parameter(nn.init.xavier_uniform_(self.edge_weight_tensor))
@@ -104,28 +130,68 @@ class GraphMessagePassing(nn.Module):
             raise RuntimeError('Unknown message_function: {}'.format(config['message_function']))
 
     def msg_pass(self, node_state, edge_vec, node2edge, edge2node):
-        node2edge_emb = torch.bmm(node2edge, node_state)                      # batch_size x num_edges x hidden_size
+        node2edge_emb = graph_bmm(node2edge, node_state)                      # batch_size x num_edges x hidden_size
         if edge_vec is not None and self.config['message_function'] == 'edge_pair':
             node2edge_emb = node2edge_emb + self.linear_edge(edge_vec)
-        agg_state = torch.bmm(edge2node, node2edge_emb)                         # consider self-loop if preprocess not igore
+        agg_state = graph_bmm(edge2node, node2edge_emb)                         # consider self-loop if preprocess not igore
         return agg_state
 
     def msg_pass_edge_mm(self, node_state, edge_vec, node2edge, edge2node):
-        node2edge_emb = torch.bmm(node2edge, node_state) # batch_size x num_edges x hidden_size
-        new_node2edge_emb = []
-        for i in range(node2edge_emb.size(1)):
-            edge_weight = F.embedding(edge_vec[:, i], self.edge_weight_tensor).view(-1, node_state.size(-1), node_state.size(-1)) # batch_size x hidden_size x hidden_size
-            new_node2edge_emb.append(torch.matmul(edge_weight, node2edge_emb[:, i].unsqueeze(-1)).squeeze(-1))
-        new_node2edge_emb = torch.stack(new_node2edge_emb, dim=1) # batch_size x num_edges x hidden_size
-        agg_state = torch.bmm(edge2node, new_node2edge_emb)
+        node2edge_emb = graph_bmm(node2edge, node_state) # batch_size x num_edges x hidden_size
+        if self.edge_message_mode == 'loop':
+            new_node2edge_emb = self.edge_mm_loop(node2edge_emb, edge_vec)
+        elif self.edge_message_mode == 'batched':
+            new_node2edge_emb = self.edge_mm_batched(node2edge_emb, edge_vec)
+        else:
+            new_node2edge_emb = self.edge_mm_grouped(node2edge_emb, edge_vec)
+        agg_state = graph_bmm(edge2node, new_node2edge_emb)
         return agg_state
 
-    def msg_pass_edge_network(self, node_state, edge_vec, node2edge, edge2node):
-        node2edge_emb = torch.bmm(node2edge, node_state) # batch_size x num_edges x hidden_size
+    def edge_mm_loop(self, node2edge_emb, edge_vec):
+        hidden_size = node2edge_emb.size(-1)
         new_node2edge_emb = []
         for i in range(node2edge_emb.size(1)):
-            edge_weight = torch.mm(edge_vec[:, i], self.edge_network.view(self.edge_network.size(0), -1)).view((-1,) + self.edge_network.shape[-2:])
+            edge_weight = F.embedding(edge_vec[:, i], self.edge_weight_tensor).view(-1, hidden_size, hidden_size) # batch_size x hidden_size x hidden_size
             new_node2edge_emb.append(torch.matmul(edge_weight, node2edge_emb[:, i].unsqueeze(-1)).squeeze(-1))
-        new_node2edge_emb = torch.stack(new_node2edge_emb, dim=1) # batch_size x num_edges x hidden_size
-        agg_state = torch.bmm(edge2node, new_node2edge_emb)
-        return agg_state
\ No newline at end of file
+        return torch.stack(new_node2edge_emb, dim=1) # batch_size x num_edges x hidden_size
+
+    def edge_mm_batched(self, node2edge_emb, edge_vec):
+        # One gather of every edge's matrix, then one einsum; needs batch_size x num_edges x hidden_size^2 memory
+        hidden_size = node2edge_emb.size(-1)
+        edge_weight = F.embedding(edge_vec, self.edge_weight_tensor).view(edge_vec.shape + (hidden_size, hidden_size))
+        return torch.einsum('behk,bek->beh', edge_weight, node2edge_emb)
+
+    def edge_mm_grouped(self, node2edge_emb, edge_vec):
+        # One matmul per edge type present in the batch, against the shared type matrix
+        hidden_size = node2edge_emb.size(-1)
+        edge_types = edge_vec.reshape(-1)
+        flat_emb = node2edge_emb.reshape(-1, hidden_size)
+        edge_weight = self.edge_weight_tensor.view(-1, hidden_size, hidden_size)
+        new_node2edge_emb = flat_emb.new_zeros(flat_emb.shape)
+        if torch.compiler.is_exporting():
+            # An exported graph cannot depend on the types present, so it has one (possibly empty) matmul per type
+            present_types = range(edge_weight.size(0))
+        else:
+            present_types = torch.unique(edge_types).tolist()
+        for edge_type in present_types:
+            ids = (edge_types == edge_type).nonzero(as_tuple=True)[0]
+            new_node2edge_emb = new_node2edge_emb.index_copy(0, ids, flat_emb.index_select(0, ids).matmul(edge_weight[edge_type].t()))
+        return new_node2edge_emb.view_as(node2edge_emb)
+
+    def msg_pass_edge_network(self, node_state, edge_vec, node2edge, edge2node):
+        node2edge_emb = graph_bmm(node2edge, node_state) # batch_size x num_edges x hidden_size
+        if self.edge_message_mode == 'loop':
+            new_node2edge_emb = []
+            for i in range(node2edge_emb.size(1)):
+                edge_weight = torch.mm(edge_vec[:, i], self.edge_network.view(self.edge_network.size(0), -1)).view((-1,) + self.edge_network.shape[-2:])
+                new_node2edge_emb.append(torch.matmul(edge_weight, node2edge_emb[:, i].unsqueeze(-1)).squeeze(-1))
+            new_node2edge_emb = torch.stack(new_node2edge_emb, dim=1) # batch_size x num_edges x hidden_size
+        else:
+            # sum_d edge_vec[d] * (edge_network[d] @ emb): project every edge with all edge_embed_dim
+            # matrices in one matmul instead of building a hidden_size^2 matrix per edge
+            edge_dim, hidden_size = self.edge_network.shape[:2]
+            projected = node2edge_emb.matmul(self.edge_network.permute(2, 0, 1).reshape(hidden_size, -1))
+            projected = projected.view(node2edge_emb.shape[:2] + (edge_dim, hidden_size))
+            new_node2edge_emb = torch.matmul(edge_vec.unsqueeze(-2), projected).squeeze(-2)
+        agg_state = graph_bmm(edge2node, new_node2edge_emb)
+        return agg_state
@@ -3,6 +3,12 @@ import yaml
 from model_handler import ModelHandler
 from model_handler_extend import ModelHandlerExtend
 from utils.search_engine import *
+from utils.vector_index import VectorIndex
+from utils.embedding_store import EmbeddingStoreWriter
+from utils.es_client import get_es_client
+from utils.data_utils import convert_dataset, data_reader_settings
+from utils.columnar_dataset import is_columnar_dataset
+from encoders import export_encoders
 import pandas as pd
 import os
 import random
@@ -36,6 +42,14 @@ def test(config, gs=False):
     model_handle.test()
 
 
+def vector_db_files(vector_db):
+    '''jsonl.gz files and columnar dataset directories in vector_db, sorted by name'''
+    for file in sorted(os.listdir(vector_db)):
+        file_path = os.path.join(vector_db, file)
+        if file.endswith('.gz') or is_columnar_dataset(file_path):
+            yield file, file_path
+
+
 def build_code_vec_database(config, local=False):
     '''
     Config Requirements: 
@@ -43,6 +57,8 @@ def build_code_vec_database(config, local=False):
     'index_name': Name of elastic index
     'index_file': Index setup file
     'vector_db': Not entirely sure?
+    'vector_backend': 'elastic' (default) or 'ann'; 'ann' writes an in-process index to 'ann_index_dir'
+    'local_index_dir': Where --local writes the memory-mapped embedding store
     '''
     print_config(config)
     print(f"{'#'*16} Building index {'remote' if not local else 'locally'} {'#'*16}")
@@ -50,29 +66,41 @@ def build_code_vec_database(config, local=False):
     if config['out_dir'] is not None:
         config['pretrained'] = config['out_dir']
         config['out_dir'] = None
-    if not local:
-        client = Elasticsearch(
-            os.getenv('ELASTIC_ENDPOINT'),
-            api_key = os.getenv('ELASTIC_API_KEY'),
-            timeout=30)
+    if not local and config.get('vector_backend', 'elastic') == 'ann':
+        index = VectorIndex(nlist=config.get('ann_nlist', 1024), nprobe=config.get('ann_nprobe', 16))
+        model_handle = ModelHandlerExtend(config)
+        for file, file_path in vector_db_files(config['vector_db']):
+            print(file)
+            model_handle.prepare_vector_db(file_path)
+            model_handle.build_code_vec_database(index)
+        index.build()
+        index.save(config['ann_index_dir'])
+        print('built ann index with {} vectors in {}'.format(len(index), config['ann_index_dir']))
+
+    elif not local:
+        client = get_es_client(config)
         client.indices.delete(index=config['index_name'], ignore=[404])
         client = create_index(client, config['index_file'])
         model_handle = ModelHandlerExtend(config)
-        for file in os.listdir(config['vector_db']):
-            if file.endswith('.gz'):
-                try:
-                    print(file)
-                    file_path = os.path.join(config['vector_db'], file)
-                    model_handle.prepare_vector_db(file_path)
-                    model_handle.build_code_vec_database(client)
-                    client.indices.refresh(index=config['index_name'])
-                except:
-                    continue
+        for file, file_path in vector_db_files(config['vector_db']):
+            try:
+                print(file)
+                model_handle.prepare_vector_db(file_path)
+                model_handle.build_code_vec_database(client)
+                client.indices.refresh(index=config['index_name'])
+            except:
+                continue
         print('built remote index successfully')
     
-    else: #TODO
-        # Currently just do nothing
-        print("Index not saved due to --local argument")
+    else:
+        store = EmbeddingStoreWriter(config['local_index_dir'], dtype=config.get('local_index_dtype', 'float32'))
+        model_handle = ModelHandlerExtend(config)
+        for file, file_path in vector_db_files(config['vector_db']):
+            print(file)
+            model_handle.prepare_vector_db(file_path)
+            model_handle.build_code_vec_database(store)
+        store.close()
+        print('built local index with {} vectors in {}'.format(len(store), config['local_index_dir']))
 
 
 
@@ -81,8 +109,7 @@ def create_search_engine(config):
     if config['out_dir'] is not None:
         config['pretrained'] = config['out_dir']
         config['out_dir'] = None
-    model_handle = ModelHandlerExtend(config)
-    se = search_engine(model_handle=model_handle, config=config)
+    se = load_search_engine(config)
     queries = pd.read_csv(config['query_file']).values.tolist()
     se.search(queries)
 
@@ -103,17 +130,35 @@ def get_config(config_path="config.yml"):
 def get_args():
     parser = argparse.ArgumentParser(description="Script with build and search modes")
     # Create subparsers for the two modes: build and search
-    subparsers = parser.add_subparsers(dest="mode", required=True, help='Mode of operation: build or search')
+    subparsers = parser.add_subparsers(dest="mode", required=True, help='Mode of operation: build, search, serve, convert or export')
     # Build mode parser
     build_parser = subparsers.add_parser('build', help='Build mode')
     build_parser.add_argument('--only-database', action='store_true', required=False, help='Use a pretrained model to create search database')
     build_parser.add_argument('--config', type=str, required=True, help='Path to the config file')
-    build_parser.add_argument('--local', '-l', action='store_true', required=False, help='Save elastic index locally instead of sending data stream')
+    build_parser.add_argument('--local', '-l', action='store_true', required=False, help='Write a memory-mapped embedding store to local_index_dir instead of Elasticsearch')
     # Search mode parser
     search_parser = subparsers.add_parser('search', help='Search mode')
     search_parser.add_argument('--config', type=str, required=True, help='Path to the config file')
     search_parser.add_argument('search_string', type=str, help='String to search for')
     search_parser.add_argument('--size', '-s', type=int, required=False, help='Number of search results to return')
+    # Serve mode parser
+    serve_parser = subparsers.add_parser('serve', help='Serve mode: keep the model loaded and answer queries over HTTP')
+    serve_parser.add_argument('--config', type=str, required=True, help='Path to the config file')
+    serve_parser.add_argument('--host', type=str, required=False, help='Host to listen on')
+    serve_parser.add_argument('--port', '-p', type=int, required=False, help='Port to listen on')
+    serve_parser.add_argument('--socket', type=str, required=False, help='Listen on this Unix socket instead of host:port')
+    # Convert mode parser
+    convert_parser = subparsers.add_parser('convert', help='Convert a jsonl.gz graph dataset to the columnar binary format')
+    convert_parser.add_argument('--config', type=str, required=True, help='Path to the config file')
+    convert_parser.add_argument('--input', '-i', type=str, required=True, help='jsonl.gz dataset to convert')
+    convert_parser.add_argument('--output', '-o', type=str, required=True, help='Directory to write the columnar dataset to')
+    convert_parser.add_argument('--database', action='store_true', required=False, help='Keep examples without a description (as read_db does)')
+    convert_parser.add_argument('--shard-size', type=int, default=100000, help='Examples per shard')
+    # Export mode parser
+    export_parser = subparsers.add_parser('export', help='Export the code and query encoders as separate inference-only artifacts')
+    export_parser.add_argument('--config', type=str, required=True, help='Path to the config file')
+    export_parser.add_argument('--output', '-o', type=str, required=True, help='Directory to write the encoders to')
+    export_parser.add_argument('--onnx', action='store_true', required=False, help='Also write the query encoder as ONNX, for query_encoder_backend: onnx')
     args = parser.parse_args()
     print(vars(args))
     return vars(args)
@@ -162,13 +207,27 @@ if __name__ == '__main__':
         build_code_vec_database(config, local=cfg['local'])
 
     elif cfg['mode'] == 'search':
-        if not (os.path.exists(config['pretrained'])):
-            raise ValueError
-        model_handle = ModelHandlerExtend(config)
-        se = search_engine(model_handle=model_handle, config=config)
+        se = load_search_engine(config)
         response = se.search_single_query(cfg['search_string'], search_size=cfg['size'])
         import pprint
         pprint.pprint(response['results'])
-        
+
+    elif cfg['mode'] == 'convert':
+        manifest = convert_dataset(cfg['input'], cfg['output'], mode='build' if cfg['database'] else 'train',
+                                   shard_size=cfg['shard_size'], **data_reader_settings(config))
+        print('Wrote {} examples in {} shards to {}'.format(manifest['num_examples'], len(manifest['shards']),
+                                                            cfg['output']))
+
+    elif cfg['mode'] == 'export':
+        if not (os.path.exists(config['pretrained'])):
+            raise ValueError('pretrained model not found: {}'.format(config['pretrained']))
+        model_handle = ModelHandlerExtend(config)
+        export_encoders(model_handle.model, cfg['output'], onnx=cfg['onnx'])
+        print('Exported code and query encoders to {}'.format(cfg['output']))
+
+    elif cfg['mode'] == 'serve':
+        from server import serve
+        serve(config, host=cfg['host'], port=cfg['port'], socket_path=cfg['socket'])
+
     else:
         raise ValueError
\ No newline at end of file
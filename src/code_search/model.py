@@ -4,10 +4,10 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from Graph2Search import Graph2Search
+from common import convert_ggnn_state_dict
+from encoders import CodeEncoder, QueryEncoder
 from utils.vocab_utils import VocabModel
 from utils import constants as Constants
-from utils.generic_utils import create_mask, to_cuda
-from common import dropout
 
 
 class Model(object):
@@ -62,7 +62,9 @@ class Model(object):
         # Merge the arguments
         if state_dict:
             merged_state_dict = self.network.state_dict()
-            for k, v in state_dict['network'].items():
+            # Checkpoints of the original and the fused GRUStep / GatedFusion layouts both load
+            network_state_dict = convert_ggnn_state_dict(state_dict['network'], self.config.get('fused_ggnn', True))
+            for k, v in network_state_dict.items():
                 if k in merged_state_dict:
                     merged_state_dict[k] = v
             self.network.load_state_dict(merged_state_dict)
@@ -213,57 +215,12 @@ def build_batch(batch, network):
 
 
 def cal_code_features(network, ex):
-    batch_size = ex['batch_size']
-    code_graphs = ex['code_graphs']
-    if network.message_function == 'edge_mm':
-        code_edge_vec = code_graphs['edge_features']
-    else:
-        code_edge_vec = network.edge_embed(code_graphs['edge_features'])
-    code_node_mask = create_mask(code_graphs['node_num'], code_graphs['max_node_num_batch'], network.device)
-    node_embedded = network.word_embed(code_graphs['node_index'])
-    node_embedded = dropout(node_embedded, network.word_dropout, shared_axes=[-2], training=network.training)
-    code_node_embedding = network.code_graph_encoder(node_embedded, code_edge_vec,
-                                                     (code_graphs['node2edge'], code_graphs['edge2node']))
-    code_sequence_embedded = network.word_embed(ex['sequences'])
-    code_sequence_embedded_mask = create_mask(ex['sequence_lens'], ex['max_code_lens'], network.device)
-    weighted_code = network.global_code_att(code_sequence_embedded, code_sequence_embedded, code_sequence_embedded,
-                                            code_sequence_embedded_mask.unsqueeze(1))
-    global_code_state = torch.div(torch.sum(weighted_code, dim=1), ex['sequence_lens'].unsqueeze(1).float())
-    local_code_state = network.graph_maxpool(code_node_embedding, code_node_mask).squeeze()
-
-    if network.code_info_type in ['all']:
-        src_state = torch.cat([local_code_state, global_code_state], dim=-1)
-    elif network.code_info_type in ['global']:
-        src_state = global_code_state
-    else:
-        src_state = local_code_state
+    src_state = CodeEncoder.from_network(network)(ex)
     return src_state.detach().cpu().numpy(), ex['code_func'], ex['file_names'], ex['urls']
 
 
 def cal_query_features(network, ex):
-    doc_graphs = ex['doc_graphs']
-    doc_words = ex['targets']
-    if network.message_function == 'edge_mm':
-        doc_edge_vec = doc_graphs['edge_features']
-    else:
-        doc_edge_vec = network.edge_embed(doc_graphs['edge_features'])
-    doc_node_mask = create_mask(doc_graphs['node_num'], doc_graphs['max_node_num_batch'], network.device)
-    doc_words_embedded = network.word_embed(doc_words)
-    doc_sequence_embedded_mask = create_mask(doc_graphs['node_num'], doc_graphs['max_node_num_batch'], network.device)
-    doc_node_embedding = network.sequence_graph_encoder(doc_words_embedded, doc_edge_vec,
-                                                        (doc_graphs['node2edge'], doc_graphs['edge2node']))
-    weighted_doc = network.global_sequence_att(doc_words_embedded, doc_words_embedded, doc_words_embedded,
-                                               doc_sequence_embedded_mask.unsqueeze(1))
-    global_doc_state = torch.div(torch.sum(weighted_doc, dim=1), ex['target_lens'].unsqueeze(1).float())
-    local_doc_state = network.graph_maxpool(doc_node_embedding, doc_node_mask).squeeze()
-    if local_doc_state.dim() == 1:
-            local_doc_state = local_doc_state.unsqueeze(0)  # Add a dimension if necessary
-    if network.des_info_type in ['all']:
-        tgt_state = torch.cat([local_doc_state, global_doc_state], dim=-1)
-    elif network.des_info_type in ['global']:
-        tgt_state = global_doc_state
-    else:
-        tgt_state = local_doc_state
+    tgt_state = QueryEncoder.from_network(network)(ex)
     return tgt_state.detach().cpu().numpy()
 
 
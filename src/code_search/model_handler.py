@@ -3,7 +3,11 @@ import torch
 import torch.backends.cudnn as cudnn
 from model import Model
 from utils.data_utils import prepare_datasets, DataStream, vectorize_input
+from utils.batch_cache import get_batch_cache
 from utils import Timer, DummyLogger, AverageMeter
+from utils.vector_index import VectorIndex
+from utils.embedding_store import EmbeddingStoreWriter
+from utils.es_client import get_es_client
 from elasticsearch.helpers import bulk
 
 
@@ -41,16 +45,22 @@ class ModelHandler(object):
         self.model = Model(config, self.train_set)
         self.model.network = self.model.network.to(self.device)
 
-        self.train_loader = DataStream(self.train_set, self.model.vocab_model.word_vocab,
-                                       self.model.vocab_model.edge_vocab, config=config,
+        vocab_model = self.model.vocab_model
+        self.train_loader = DataStream(self.train_set, vocab_model.word_vocab,
+                                       vocab_model.edge_vocab, config=config,
                                        isShuffle=True,
-                                       isLoop=True, isSort=True)
+                                       isLoop=True, isSort=True,
+                                       batch_cache=get_batch_cache(config, config['trainset'], vocab_model.word_vocab,
+                                                                   vocab_model.edge_vocab, config['batch_size'],
+                                                                   is_shuffle=True))
         self._n_train_batches = self.train_loader.get_num_batch()
 
-        self.dev_loader = DataStream(self.dev_set, self.model.vocab_model.word_vocab,
-                                     self.model.vocab_model.edge_vocab, config=config,
+        self.dev_loader = DataStream(self.dev_set, vocab_model.word_vocab,
+                                     vocab_model.edge_vocab, config=config,
                                      isShuffle=False,
-                                     isLoop=True, isSort=True)
+                                     isLoop=True, isSort=True,
+                                     batch_cache=get_batch_cache(config, config['devset'], vocab_model.word_vocab,
+                                                                 vocab_model.edge_vocab, config['batch_size'], mode='dev'))
         self._n_dev_batches = self.dev_loader.get_num_batch()
 
         self.config = self.model.config
@@ -152,6 +162,12 @@ class ModelHandler(object):
                 code_funcs.extend(res['code_funcs'])
                 file_names.extend(res['file_names'])
                 code_urls.extend(res['urls'])
+        padding = data_loader.padding_efficiency()
+        if padding is not None:
+            format_str = '[{}] padding efficiency: nodes = {:0.3f} | edges = {:0.3f}'.format(
+                mode, padding['nodes'], padding['edges'])
+            self.logger.write_to_file(format_str)
+            print(format_str)
         if mode == 'building':
             self.index_data(client, code_states, code_funcs, file_names, code_urls)
 
@@ -220,6 +236,11 @@ class ModelHandler(object):
         return False if exceeded_max_epochs or no_improvement else True
 
     def index_data(self, client, code_states, code_funcs, file_names, code_urls):
+        if isinstance(client, (VectorIndex, EmbeddingStoreWriter)):
+            client.add(code_states, code_funcs, file_names, code_urls)
+            return
+        if client is None:
+            client = get_es_client(self.config)
         requests = []
         for index in range(len(code_states)):
             request = {}
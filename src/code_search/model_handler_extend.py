@@ -1,9 +1,11 @@
 import torch
 import torch.backends.cudnn as cudnn
 from model import Model
-from utils.data_utils import read_db, DataStream, read_all_Datasets
+from utils.data_utils import read_db, DataStream, read_all_Datasets, data_reader_settings
+from utils.batch_cache import get_batch_cache
 from utils import Timer, DummyLogger, AverageMeter
 from model_handler import ModelHandler
+from encoders import quantize_dynamic_int8
 
 
 class ModelHandlerExtend(ModelHandler):
@@ -17,6 +19,7 @@ class ModelHandlerExtend(ModelHandler):
     'no_cuda'
     'cuda_id'
     'device'
+    'quantize_int8': Optional, int8 dynamic quantization of the Linear layers on CPU
     '''
     def __init__(self, config):
         self.logger = DummyLogger(config, dirname=config['out_dir'], pretrained=config['pretrained'])
@@ -36,20 +39,33 @@ class ModelHandlerExtend(ModelHandler):
 
         self.model = Model(config, None)
         self.model.network = self.model.network.to(self.device)
+        if config.get('quantize_int8', False):
+            if self.device.type == 'cpu':
+                print('[ Using dynamic int8 quantization ]')
+                self.model.network = quantize_dynamic_int8(self.model.network)
+            else:
+                print('[ quantize_int8 only applies on CPU, keeping float weights ]')
         self.config = self.model.config
         self.is_test = False
         self.is_building = False
 
     def prepare_vector_db(self, file_path):
-        build_set, build_code_graph_len_stats = read_db(file_path)
-        print('# of database examples: {}'.format(len(build_set)))
-        print('Database code graph node length: {}'.format(build_code_graph_len_stats))
-        self.build_loader = DataStream(build_set, self.model.vocab_model.word_vocab,
-                                       self.model.vocab_model.edge_vocab, config=self.config,
+        vocab_model = self.model.vocab_model
+        batch_cache = get_batch_cache(self.config, file_path, vocab_model.word_vocab, vocab_model.edge_vocab,
+                                      self.config['test_batch_size'], mode='build')
+        if batch_cache is not None and batch_cache.is_complete():
+            print('Using cached database batches in {}'.format(batch_cache.dirname))
+            build_set = None
+        else:
+            build_set, build_code_graph_len_stats = read_db(file_path, **data_reader_settings(self.config))
+            print('# of database examples: {}'.format(len(build_set)))
+            print('Database code graph node length: {}'.format(build_code_graph_len_stats))
+        self.build_loader = DataStream(build_set, vocab_model.word_vocab,
+                                       vocab_model.edge_vocab, config=self.config,
                                        isShuffle=False, isLoop=False, isSort=True,
-                                       batch_size=self.config['test_batch_size'])
+                                       batch_size=self.config['test_batch_size'], batch_cache=batch_cache)
         self._n_build_batches = self.build_loader.get_num_batch()
-        self._n_build_examples = len(build_set)
+        self._n_build_examples = self.build_loader.get_num_instance()
 
     def build_code_vec_database(self, client):
         if self.build_loader is None:
@@ -65,16 +81,24 @@ class ModelHandlerExtend(ModelHandler):
 
     def test(self):
         self.is_test = True
-        test_set, test_src_len, test_tgt_len = read_all_Datasets(self.config['testset'], isLower=True)
-        print('# of testing examples: {}'.format(len(test_set)))
-        print('Test source sentence length: {}'.format(test_src_len))
-        print('Test target sentence length: {}'.format(test_tgt_len))
-        self.test_loader = DataStream(test_set, self.model.vocab_model.word_vocab,
-                                      self.model.vocab_model.edge_vocab, config=self.config,
+        vocab_model = self.model.vocab_model
+        batch_cache = get_batch_cache(self.config, self.config['testset'], vocab_model.word_vocab,
+                                      vocab_model.edge_vocab, self.config['test_batch_size'], mode='train')
+        if batch_cache is not None and batch_cache.is_complete():
+            print('Using cached test batches in {}'.format(batch_cache.dirname))
+            test_set = None
+        else:
+            test_set, test_src_len, test_tgt_len = read_all_Datasets(self.config['testset'], isLower=True,
+                                                                     **data_reader_settings(self.config))
+            print('# of testing examples: {}'.format(len(test_set)))
+            print('Test source sentence length: {}'.format(test_src_len))
+            print('Test target sentence length: {}'.format(test_tgt_len))
+        self.test_loader = DataStream(test_set, vocab_model.word_vocab,
+                                      vocab_model.edge_vocab, config=self.config,
                                       isShuffle=False, isLoop=False, isSort=True,
-                                      batch_size=self.config['test_batch_size'])
+                                      batch_size=self.config['test_batch_size'], batch_cache=batch_cache)
         self._n_test_batches = self.test_loader.get_num_batch()
-        self._n_test_examples = len(test_set)
+        self._n_test_examples = self.test_loader.get_num_instance()
         timer = Timer("Test")
         for param in self.model.network.parameters():
             param.requires_grad = False
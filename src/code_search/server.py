@@ -0,0 +1,137 @@
+import json
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from utils.search_engine import load_search_engine
+
+
+class SearchServer(object):
+    """Answers queries from many request threads with one warm `search_engine`.
+
+    Each request thread parses its own query and searches the backend; the query
+    embedding goes through the engine's `QueryBatcher`, which pads the queries that
+    arrive together into one forward pass.
+    """
+    def __init__(self, se):
+        self.se = se
+
+    def search(self, query, search_size=10):
+        return self.se.search_single_query(query, search_size)
+
+
+def parse_size(size):
+    """Search size from a query parameter or a JSON field, as a positive int; None when not given."""
+    if size is None:
+        return None
+    if isinstance(size, str) and size.strip().isdigit():
+        size = int(size)
+    if isinstance(size, bool) or not isinstance(size, int) or size <= 0:
+        raise ValueError('size must be a positive integer, got {!r}'.format(size))
+    return size
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """GET /search?q=...&size=N, POST /search with {"query": ..., "size": N}, GET /health, GET /stats."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self._send(200, {'status': 'ok'})
+        if url.path == '/stats':
+            return self._send(200, self.server.search_server.se.cache_stats())
+        if url.path != '/search':
+            return self._send(404, {'error': 'Unknown path: {}'.format(url.path)})
+        params = parse_qs(url.query)
+        if 'q' not in params:
+            return self._send(400, {'error': 'Missing query parameter q'})
+        try:
+            size = parse_size(params['size'][0] if 'size' in params else None)
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        self._search(params['q'][0], size)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/search':
+            return self._send(404, {'error': 'Unknown path: {}'.format(self.path)})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._send(400, {'error': 'Request body is not valid JSON'})
+        if not isinstance(body, dict):
+            return self._send(400, {'error': 'Request body must be a JSON object'})
+        if 'query' not in body:
+            return self._send(400, {'error': 'Missing field query'})
+        if not isinstance(body['query'], str):
+            return self._send(400, {'error': 'Field query must be a string'})
+        try:
+            size = parse_size(body.get('size'))
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        self._search(body['query'], size)
+
+    def _search(self, query, size):
+        try:
+            response = self.server.search_server.search(query, size or self.server.default_size)
+        except Exception as e:
+            return self._send(500, {'error': str(e)})
+        self._send(200, response)
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(ThreadingUnixHTTPServer, self).get_request()
+        # BaseHTTPRequestHandler expects a (host, port) style client address
+        return request, ('unix', 0)
+
+
+def serve(config, host=None, port=None, socket_path=None):
+    '''
+    Config Requirements:
+    'pretrained': Location of saved model, or
+    'query_encoder_dir': Query encoder exported with `main.py export`, loaded without the full model
+    'serve_host', 'serve_port' or 'serve_socket': Where to listen, overridden by the command line
+    'query_batch_size', 'query_batch_wait_ms': Micro-batching of concurrent queries
+    '''
+    config['query_batching'] = True
+    se = load_search_engine(config)
+    search_server = SearchServer(se)
+    socket_path = socket_path or config.get('serve_socket')
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = ThreadingUnixHTTPServer(socket_path, SearchRequestHandler)
+        address = socket_path
+    else:
+        host = host or config.get('serve_host', '127.0.0.1')
+        port = port or config.get('serve_port', 8080)
+        httpd = ThreadingHTTPServer((host, port), SearchRequestHandler)
+        httpd.daemon_threads = True
+        address = 'http://{}:{}'.format(host, port)
+    httpd.search_server = search_server
+    httpd.default_size = config.get('serve_default_size', 10)
+    print('[ Serving code search on {} ]'.format(address))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        se.save_caches()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
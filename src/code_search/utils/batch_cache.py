@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Module to keep vectorized batches on disk between runs.
+"""
+import os
+import json
+import hashlib
+from .generic_utils import file_sha1
+from .columnar_dataset import manifest_path
+
+
+# Bump when the layout written by Batch.save changes
+BATCH_CACHE_VERSION = 1
+
+
+def vocab_sha1(word_vocab, edge_vocab):
+    sha1 = hashlib.sha1()
+    for vocab in (word_vocab, edge_vocab):
+        sha1.update(json.dumps(vocab.index2word).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class BatchCache(object):
+    """Directory of the vectorized batches of one DataStream.
+
+    The directory name hashes the dataset file contents, the vocabs and every
+    setting that changes the batches, so a stale cache is never read: a changed
+    dataset, vocab, batch size, budget or (for a shuffled stream) seed simply gets
+    a new directory. A cache only counts as complete once `finish` has written its manifest.
+    """
+    def __init__(self, cache_dir, inpath, word_vocab, edge_vocab, config, batch_size, mode='train', is_shuffle=False):
+        key = {'version': BATCH_CACHE_VERSION,
+               'dataset': file_sha1(manifest_path(inpath)),
+               'vocab': vocab_sha1(word_vocab, edge_vocab),
+               'batch_size': batch_size,
+               'batch_budget': config.get('batch_budget', 0),
+               'bucket_width': config.get('bucket_width', 10),
+               # The seeded bucket shuffle of DataStream decides which examples share a batch
+               'shuffle': is_shuffle,
+               'random_seed': config.get('random_seed', 0) if is_shuffle else None,
+               'mode': mode,
+               'model_name': config['model_name']}
+        self.key = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        self.dirname = os.path.join(cache_dir, self.key)
+        self.manifest_file = os.path.join(self.dirname, 'batches.json')
+
+    def is_complete(self):
+        return os.path.exists(self.manifest_file)
+
+    def manifest(self):
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def batch_path(self, i):
+        return os.path.join(self.dirname, 'batch_{:06d}'.format(i))
+
+    def save_batch(self, i, batch):
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        batch.save(self.batch_path(i))
+
+    def finish(self, num_batches, num_instances):
+        with open(self.manifest_file, 'w') as f:
+            json.dump({'num_batches': num_batches, 'num_instances': num_instances}, f)
+
+
+def get_batch_cache(config, inpath, word_vocab, edge_vocab, batch_size, mode='train', is_shuffle=False):
+    """BatchCache for the dataset at `inpath`, or None when 'batch_cache_dir' is not configured."""
+    if not config.get('batch_cache_dir') or not inpath or not os.path.exists(inpath):
+        return None
+    return BatchCache(config['batch_cache_dir'], inpath, word_vocab, edge_vocab, config, batch_size, mode, is_shuffle)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Module for the columnar binary form of preprocessed code/description graph datasets.
+
+A dataset is a directory with a `dataset.json` manifest and one sub-directory per
+shard. A shard holds one .npy file per column plus `strings.json`:
+
+    strings.json            string table (node contents, tokens, edge types) and the
+                            per-example function / identifier / url / seq_token_in_node
+    code_nodes.npy          string id of every code node, concatenated over examples
+    code_seq.npy            string id of every code token
+    code_edge_types.npy     string id of every code edge type
+    code_edge_src.npy       source node of every code edge, local to its example
+    code_edge_dst.npy       destination node of every code edge, local to its example
+    code_*_offsets.npy      example i owns rows offsets[i]: offsets[i + 1] of the column
+    doc_*.npy               the same for description graphs, whose nodes are its tokens
+
+Strings are kept instead of vocab ids so one conversion serves any vocab; each shard
+maps its string table through a vocab once, and batching then works on id arrays only.
+"""
+import os
+import json
+import numpy as np
+from .generic_utils import file_sha1
+
+
+COLUMNAR_VERSION = 1
+MANIFEST_FILE = 'dataset.json'
+GRAPH_COLUMNS = ('nodes', 'seq', 'edge_types', 'edge_src', 'edge_dst')
+
+
+def is_columnar_dataset(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def manifest_path(path):
+    """File whose contents identify the dataset at `path` (for cache keys)."""
+    return os.path.join(path, MANIFEST_FILE) if is_columnar_dataset(path) else path
+
+
+class ShardWriter(object):
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.string_ids = {}
+        self.strings = []
+        self.columns = {}
+        self.offsets = {}
+        self.meta = {'function': [], 'identifier': [], 'url': [], 'seq_token_in_node': []}
+        self.num_examples = 0
+        self.has_doc = False
+
+    def _ids(self, strings):
+        ids = []
+        for string in strings:
+            if string not in self.string_ids:
+                self.string_ids[string] = len(self.strings)
+                self.strings.append(string)
+            ids.append(self.string_ids[string])
+        return ids
+
+    def _append(self, prefix, name, values):
+        column = prefix + name
+        self.columns.setdefault(column, []).extend(values)
+        offsets = self.offsets.setdefault(column, [0])
+        offsets.append(offsets[-1] + len(values))
+
+    def _add_graph(self, prefix, graph, nodes):
+        self._append(prefix, 'nodes', self._ids(nodes))
+        self._append(prefix, 'seq', self._ids(graph['backbone_sequence']))
+        self._append(prefix, 'edge_types', self._ids(graph['edge_types']))
+        self._append(prefix, 'edge_src', graph['edge_src'].tolist())
+        self._append(prefix, 'edge_dst', graph['edge_dst'].tolist())
+
+    def add(self, sent1, sent2):
+        self._add_graph('code_', sent1.graph, [node['content'] for node in sent1.graph['nodes']])
+        if sent2 is not None:
+            self.has_doc = True
+            self._add_graph('doc_', sent2.graph, sent2.graph['backbone_sequence'])
+        self.meta['function'].append(sent1.function)
+        self.meta['identifier'].append(sent1.filename)
+        self.meta['url'].append(sent1.url)
+        self.meta['seq_token_in_node'].append(sent1.seq_token_in_node)
+        self.num_examples += 1
+
+    def close(self):
+        os.makedirs(self.dirname, exist_ok=True)
+        for column, values in self.columns.items():
+            np.save(os.path.join(self.dirname, column + '.npy'), np.asarray(values, dtype=np.int32))
+            np.save(os.path.join(self.dirname, column + '_offsets.npy'),
+                    np.asarray(self.offsets[column], dtype=np.int64))
+        with open(os.path.join(self.dirname, 'strings.json'), 'w') as f:
+            json.dump(dict(self.meta, strings=self.strings), f)
+        files = sorted(os.listdir(self.dirname))
+        return {'name': os.path.basename(self.dirname), 'num_examples': self.num_examples,
+                'sha1': {name: file_sha1(os.path.join(self.dirname, name)) for name in files}}
+
+
+def write_columnar_dataset(instances, outdir, shard_size=100000, mode='train'):
+    """Writes `(sent1, sent2)` Graph pairs (sent2 may be None) as a columnar dataset.
+
+    `instances` can be any iterable, e.g. the generator of `parallel_process_stream`,
+    so only one shard is held in memory at a time.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    shards = []
+    writer = None
+    has_doc = False
+    for instance in instances:
+        if type(instance) is not tuple:
+            continue
+        if writer is None:
+            writer = ShardWriter(os.path.join(outdir, 'shard_{:05d}'.format(len(shards))))
+        writer.add(*instance)
+        if writer.num_examples >= shard_size:
+            has_doc = has_doc or writer.has_doc
+            shards.append(writer.close())
+            writer = None
+    if writer is not None:
+        has_doc = has_doc or writer.has_doc
+        shards.append(writer.close())
+    manifest = {'version': COLUMNAR_VERSION, 'mode': mode, 'has_doc': has_doc,
+                'num_examples': sum(shard['num_examples'] for shard in shards), 'shards': shards}
+    with open(os.path.join(outdir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+class ColumnarShard(object):
+    """One shard of a columnar dataset; the columns are memory-mapped."""
+    def __init__(self, dirname, with_doc=True):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'strings.json')) as f:
+            meta = json.load(f)
+        self.strings = meta['strings']
+        self.functions = meta['function']
+        self.identifiers = meta['identifier']
+        self.urls = meta['url']
+        self.seq_token_in_node = meta['seq_token_in_node']
+        prefixes = ['code_'] + (['doc_'] if with_doc and os.path.exists(os.path.join(dirname, 'doc_seq.npy')) else [])
+        self.columns = {}
+        for prefix in prefixes:
+            for name in GRAPH_COLUMNS:
+                column = prefix + name
+                self.columns[column] = np.load(os.path.join(dirname, column + '.npy'), mmap_mode='r')
+                self.columns[column + '_offsets'] = np.load(os.path.join(dirname, column + '_offsets.npy'))
+        self.has_doc = 'doc_seq' in self.columns
+        self._vocab_ids = {}
+
+    def __len__(self):
+        return len(self.functions)
+
+    def vocab_ids(self, vocab):
+        """Vocab index of every string in the table, looked up once per vocab."""
+        key = id(vocab)
+        if key not in self._vocab_ids:
+            self._vocab_ids[key] = (vocab, vocab.lookup_many(self.strings))
+        return self._vocab_ids[key][1]
+
+    def _columns(self, prefix, i):
+        values = {}
+        for name in GRAPH_COLUMNS:
+            offsets = self.columns[prefix + name + '_offsets']
+            values[name] = self.columns[prefix + name][offsets[i]: offsets[i + 1]]
+        return values
+
+    def instances(self):
+        for i in range(len(self)):
+            sent1 = IndexedGraph(self, **self._columns('code_', i))
+            sent1.function = self.functions[i]
+            sent1.filename = self.identifiers[i]
+            sent1.url = self.urls[i]
+            sent1.seq_token_in_node = self.seq_token_in_node[i]
+            sent2 = IndexedGraph(self, **self._columns('doc_', i)) if self.has_doc else None
+            yield sent1, sent2
+
+
+class IndexedGraph(object):
+    """A code or description graph read from a `ColumnarShard`, as string-id arrays.
+
+    Stands in for `data_utils.Graph` in `DataStream` and `Batch`.
+    """
+    __slots__ = ('shard', 'nodes', 'seq', 'edge_types', 'edge_src', 'edge_dst',
+                 'function', 'filename', 'url', 'seq_token_in_node')
+
+    def __init__(self, shard, nodes, seq, edge_types, edge_src, edge_dst):
+        self.shard = shard
+        self.nodes = nodes
+        self.seq = seq
+        self.edge_types = edge_types
+        self.edge_src = edge_src
+        self.edge_dst = edge_dst
+
+    def get_node_length(self):
+        return len(self.nodes)
+
+    def get_token_length(self):
+        return len(self.seq)
+
+    def get_edge_length(self):
+        return len(self.edge_types)
+
+    def node_ids(self, word_vocab):
+        return self.shard.vocab_ids(word_vocab)[self.nodes]
+
+    def seq_ids(self, word_vocab):
+        return self.shard.vocab_ids(word_vocab)[self.seq]
+
+    def edge_type_ids(self, edge_vocab):
+        return self.shard.vocab_ids(edge_vocab)[self.edge_types]
+
+    def sequence_words(self):
+        strings = self.shard.strings
+        return [strings[i] for i in self.seq]
+
+    def edge_type_words(self):
+        strings = self.shard.strings
+        return [strings[i] for i in self.edge_types]
+
+    def text(self):
+        return ' '.join(self.sequence_words())
+
+
+def load_columnar_dataset(dirname, with_doc=True):
+    """Returns the `(sent1, sent2)` IndexedGraph pairs of a columnar dataset; sent2 is None without docs."""
+    with open(os.path.join(dirname, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest['version'] != COLUMNAR_VERSION:
+        raise RuntimeError('Unsupported columnar dataset version {} in {}'.format(manifest['version'], dirname))
+    all_instances = []
+    for shard in manifest['shards']:
+        all_instances.extend(ColumnarShard(os.path.join(dirname, shard['name']), with_doc=with_doc).instances())
+    return all_instances
@@ -4,10 +4,16 @@ Module to handle getting data loading classes and helper functions.
 """
 import torch
 import json
+import random
+import threading
+from collections import deque
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from random import shuffle
 import numpy as np
-from scipy.sparse import *
 from . import padding_utils
+from .columnar_dataset import IndexedGraph, is_columnar_dataset, load_columnar_dataset, write_columnar_dataset
 import gzip
 from tqdm import tqdm
 import multiprocessing
@@ -44,7 +50,8 @@ def vectorize_input(batch, training=True, device=None, mode='train'):
 
 def prepare_datasets(config):
     if config['trainset'] is not None:
-        train_set, train_src_len, train_tgt_len = read_all_Datasets(config['trainset'], isLower=True)
+        train_set, train_src_len, train_tgt_len = read_all_Datasets(config['trainset'], isLower=True,
+                                                                    **data_reader_settings(config))
         print('# of training examples: {}'.format(len(train_set)))
         print('Training source sentence length: {}'.format(train_src_len))
         print('Training target sentence length: {}'.format(train_tgt_len))
@@ -52,7 +59,8 @@ def prepare_datasets(config):
         train_set = None
 
     if config['devset'] is not None:
-        dev_set, dev_src_len, dev_tgt_len = read_all_Datasets(config['devset'], isLower=True)
+        dev_set, dev_src_len, dev_tgt_len = read_all_Datasets(config['devset'], isLower=True,
+                                                              **data_reader_settings(config))
         print('# of dev examples: {}'.format(len(dev_set)))
         print('Dev source sentence length: {}'.format(dev_src_len))
         print('Dev target sentence length: {}'.format(dev_tgt_len))
@@ -61,16 +69,24 @@ def prepare_datasets(config):
     return {'train': train_set, 'dev': dev_set}
 
 
-def read_all_Datasets(inpath, isLower=True):
+def data_reader_settings(config):
+    return {'n_cores': config.get('data_workers', None),
+            'block_size': config.get('data_block_size', 20000),
+            'chunk_size': config.get('data_chunk_size', 500)}
+
+
+def read_all_Datasets(inpath, isLower=True, n_cores=None, block_size=20000, chunk_size=500):
     all_instances = []
     code_graph_len = []
     doc_token_len = []
     # determine if the file exists
     import os
     if os.path.exists(inpath):
-        with gzip.GzipFile(inpath, 'r') as f:
-            lines = list(f)
-        results = parallel_process(lines, single_instance_process, args=(isLower,))
+        if is_columnar_dataset(inpath):
+            results = load_columnar_dataset(inpath)
+        else:
+            results = parallel_process_stream(iter_gzip_lines(inpath), single_instance_process, args=(isLower,),
+                                              n_cores=n_cores, block_size=block_size, chunk_size=chunk_size)
         for result in results:
             if type(result) is tuple:
                 (sent1, sent2) = result
@@ -84,6 +100,12 @@ def read_all_Datasets(inpath, isLower=True):
         print("File at path: {} does not exist".format(inpath))
 
 
+def iter_gzip_lines(inpath):
+    with gzip.GzipFile(inpath, 'r') as f:
+        for line in f:
+            yield line
+
+
 def single_instance_process(line, isLower, mode='train'):
     instance = json.loads(line)
     code_graph = instance['code_graph']
@@ -119,12 +141,49 @@ def parallel_process(array, single_instance_process, args=(), n_cores=None):
         return results
 
 
-def read_db(inpath, isLower=True):
+def _call_with_args(function, args, x):
+    return function(x, *args)
+
+
+def parallel_process_stream(lines, single_instance_process, args=(), n_cores=None, block_size=20000, chunk_size=500):
+    """Yields `single_instance_process(line, *args)` for every line, in order.
+
+    Lines are read from the iterator `block_size` at a time and handed to the pool
+    in chunks of `chunk_size`, so the input is never fully resident and pickling
+    costs one message per chunk instead of one per line.
+    """
+    function = partial(_call_with_args, single_instance_process, args)
+    if n_cores == 1:
+        for line in tqdm(lines):
+            yield function(line)
+        return
+    if n_cores is None:
+        n_cores = multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes=n_cores) as pool, tqdm() as pbar:
+        while True:
+            block = list(islice(lines, block_size))
+            if not block:
+                break
+            for result in pool.imap(function, block, chunksize=max(1, min(chunk_size, len(block) // n_cores))):
+                pbar.update()
+                yield result
+
+
+def convert_dataset(inpath, outdir, mode='train', shard_size=100000, isLower=True, **reader_settings):
+    """Parses the jsonl.gz dataset at `inpath` once and writes it as a columnar dataset to `outdir`."""
+    results = parallel_process_stream(iter_gzip_lines(inpath), single_instance_process, args=(isLower, mode),
+                                      **reader_settings)
+    return write_columnar_dataset(results, outdir, shard_size=shard_size, mode=mode)
+
+
+def read_db(inpath, isLower=True, n_cores=None, block_size=20000, chunk_size=500):
     all_instances = []
     code_graph_len = []
-    with gzip.GzipFile(inpath, 'r') as f:
-        lines = list(f)
-    results = parallel_process(lines, single_instance_process, args=(isLower, 'build'))
+    if is_columnar_dataset(inpath):
+        results = load_columnar_dataset(inpath, with_doc=False)
+    else:
+        results = parallel_process_stream(iter_gzip_lines(inpath), single_instance_process, args=(isLower, 'build'),
+                                          n_cores=n_cores, block_size=block_size, chunk_size=chunk_size)
     for result in results:
         if type(result) is tuple:
             (sent1, sent2) = result
@@ -135,43 +194,174 @@ def read_db(inpath, isLower=True):
     return all_instances, code_graph_len_stats
 
 
+class BatchPrefetcher(object):
+    """Builds the batches at `indices` with `make_batch` on worker threads, ahead of the consumer.
+
+    At most `depth` batches are built or waiting at any time, and `next` hands them
+    out in the order of `indices`.
+    """
+    def __init__(self, make_batch, indices, depth=4, num_workers=1):
+        self.make_batch = make_batch
+        self.indices = iter(indices)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = deque()
+        for _ in range(depth):
+            self._submit()
+
+    def _submit(self):
+        index = next(self.indices, None)
+        if index is not None:
+            self.pending.append(self.pool.submit(self.make_batch, index))
+
+    def next(self):
+        if not self.pending:
+            return None
+        batch = self.pending.popleft().result()
+        self._submit()
+        return batch
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.pool.shutdown(wait=False)
+
+
 class DataStream(object):
+    """Batches of `all_instances`, sorted by code graph size.
+
+    By default every batch is built up front. With `stream` (config 'stream_batches')
+    only the sorted instances and the batch boundaries are kept, and batches are built,
+    or read from the batch cache, on demand by a `BatchPrefetcher`, so only about
+    'prefetch_batches' of them are in memory at once.
+
+    With config 'batch_budget' batches are packed up to that many padded
+    batch x max_nodes x max_edges slots instead of cut into fixed batch_size spans.
+    Shuffled (training) streams then order graphs by node count range only
+    ('bucket_width'), in a seeded random order within each range.
+    """
     def __init__(self, all_instances, word_vocab, edge_vocab, config=None,
-                 isShuffle=False, isLoop=False, isSort=True, batch_size=-1):
+                 isShuffle=False, isLoop=False, isSort=True, batch_size=-1, batch_cache=None, stream=None):
         self.config = config
         if batch_size == -1: batch_size = config['batch_size']
-        if isSort:
-            all_instances = sorted(all_instances, key=lambda instance: (instance[0].get_node_length()))
+        self.word_vocab = word_vocab
+        self.edge_vocab = edge_vocab
+        self.stream = config.get('stream_batches', False) if stream is None else stream
+        self.prefetch_batches = config.get('prefetch_batches', 4)
+        self.prefetch_workers = config.get('prefetch_workers', 1)
+        self.prefetcher = None
+        self.batches = None
+        self.all_instances = None
+        self.batch_cache = batch_cache
+        self._saved_batches = set()
+        self._cache_lock = threading.Lock()
+        self._padding = [0, 0, 0, 0]
+        batch_budget = config.get('batch_budget', 0)
+        if batch_cache is not None and batch_cache.is_complete():
+            # Vectorized batches of the same dataset, vocab and batch size are already on disk
+            manifest = batch_cache.manifest()
+            self.num_instances = manifest['num_instances']
+            self.num_batch = manifest['num_batches']
+            if not self.stream:
+                self.batches = [Batch.load(batch_cache.batch_path(i), config)
+                                for i in tqdm(range(self.num_batch), desc='Loading cached batches')]
         else:
-            random.shuffle(all_instances)
-            random.shuffle(all_instances)
-        self.num_instances = len(all_instances)
-
-        # distribute srcs into different buckets
-        batch_spans = padding_utils.make_batches(self.num_instances, batch_size)
-        self.batches = []
-        for (batch_start, batch_end) in tqdm(batch_spans):
-            cur_instances = all_instances[batch_start: batch_end]
-            cur_batch = Batch(cur_instances, config, word_vocab, edge_vocab)
-            self.batches.append(cur_batch)
-
-        self.num_batch = len(self.batches)
+            if isSort and batch_budget and isShuffle:
+                # Seeded, so the batches stay reproducible and cacheable
+                bucket_width = config.get('bucket_width', 10)
+                all_instances = list(all_instances)
+                random.Random(config.get('random_seed', 0)).shuffle(all_instances)
+                all_instances.sort(key=lambda instance: instance[0].get_node_length() // bucket_width)
+            elif isSort:
+                all_instances = sorted(all_instances, key=lambda instance: (instance[0].get_node_length()))
+            else:
+                random.shuffle(all_instances)
+                random.shuffle(all_instances)
+                # A shuffled order is not reproducible, so it is never cached
+                self.batch_cache = batch_cache = None
+            self.num_instances = len(all_instances)
+
+            # distribute srcs into different buckets
+            if batch_budget:
+                sizes = [(instance[0].get_node_length(), instance[0].get_edge_length()) for instance in all_instances]
+                self.batch_spans = padding_utils.make_budget_batches(sizes, batch_size, batch_budget)
+            else:
+                self.batch_spans = padding_utils.make_batches(self.num_instances, batch_size)
+            self.num_batch = len(self.batch_spans)
+            if self.stream:
+                self.all_instances = all_instances
+            else:
+                self.batches = []
+                for (batch_start, batch_end) in tqdm(self.batch_spans):
+                    cur_batch = self._build_batch(all_instances[batch_start: batch_end], len(self.batches))
+                    self.batches.append(cur_batch)
+
         self.index_array = np.arange(self.num_batch)
         self.isShuffle = isShuffle
         if self.isShuffle: np.random.shuffle(self.index_array)
         self.isLoop = isLoop
         self.cur_pointer = 0
 
+    def _build_batch(self, instances, i):
+        cur_batch = Batch(instances, self.config, self.word_vocab, self.edge_vocab)
+        if self.batch_cache is not None:
+            self.batch_cache.save_batch(i, cur_batch)
+            with self._cache_lock:
+                self._saved_batches.add(i)
+                if len(self._saved_batches) == self.num_batch:
+                    self.batch_cache.finish(self.num_batch, self.num_instances)
+        return cur_batch
+
+    def _make_batch(self, i):
+        if self.all_instances is None or i in self._saved_batches:
+            return Batch.load(self.batch_cache.batch_path(i), self.config)
+        batch_start, batch_end = self.batch_spans[i]
+        return self._build_batch(self.all_instances[batch_start: batch_end], i)
+
+    def _stop_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
     def nextBatch(self):
         if self.cur_pointer >= self.num_batch:
             if not self.isLoop: return None
             self.cur_pointer = 0
             if self.isShuffle: np.random.shuffle(self.index_array)
-        cur_batch = self.batches[self.index_array[self.cur_pointer]]
+        if self.stream:
+            if self.cur_pointer == 0 or self.prefetcher is None:
+                # One prefetcher per pass over index_array
+                self._stop_prefetch()
+                self.prefetcher = BatchPrefetcher(self._make_batch, self.index_array[self.cur_pointer:].tolist(),
+                                                  depth=self.prefetch_batches, num_workers=self.prefetch_workers)
+            cur_batch = self.prefetcher.next()
+        else:
+            cur_batch = self.batches[self.index_array[self.cur_pointer]]
         self.cur_pointer += 1
+        self._count_padding(cur_batch)
         return cur_batch
 
+    def _count_padding(self, batch):
+        graph = batch.code_graph_arrays
+        if graph is None:
+            return
+        num_graphs = len(graph['node_num'])
+        self._padding[0] += int(np.sum(graph['node_num']))
+        self._padding[1] += num_graphs * int(graph['max_num_nodes'])
+        self._padding[2] += len(graph['edge_ids'])
+        self._padding[3] += num_graphs * int(graph['max_num_edges'])
+
+    def padding_efficiency(self):
+        """Share of real nodes and edges among the padded code graph slots of the batches
+        returned since the last call, or None if there were none."""
+        real_nodes, node_slots, real_edges, edge_slots = self._padding
+        self._padding = [0, 0, 0, 0]
+        if node_slots == 0:
+            return None
+        return {'nodes': real_nodes / node_slots, 'edges': real_edges / edge_slots if edge_slots else 1.0}
+
     def reset(self):
+        self._stop_prefetch()
         if self.isShuffle: np.random.shuffle(self.index_array)
         self.cur_pointer = 0
 
@@ -183,11 +373,16 @@ class DataStream(object):
 
     def get_batch(self, i):
         if i >= self.num_batch: return None
+        if self.stream:
+            return self._make_batch(i)
         return self.batches[i]
 
 
 class Batch(object):
     def __init__(self, instances, config, word_vocab, edge_vocab):
+        if isinstance(instances[0][0], IndexedGraph):
+            self._init_indexed(instances, config, word_vocab, edge_vocab)
+            return
         self.instances = instances
         self.batch_size = len(instances)
         # Create word representation and length
@@ -207,32 +402,22 @@ class Batch(object):
             batch_code_graph.append(sent1.graph)
             if sent2 is not None:
                 batch_doc_graph.append(sent2.graph)
+        self.code_graph_arrays = None
+        self.doc_graph_arrays = None
         if config['model_name'] in ['Graph2Search']:
             batch_code_graphs = cons_batch_graph(batch_code_graph, word_vocab)
-            self.code_graph = vectorize_batch_graph(batch_code_graphs, config, edge_vocab)
+            self.code_graph_arrays = batch_graph_arrays(batch_code_graphs, edge_vocab)
             if len(batch_doc_graph) > 0:
                 batch_doc_graphs = cons_batch_graph(batch_doc_graph, word_vocab)
-                self.doc_graph = vectorize_batch_graph(batch_doc_graphs, config, edge_vocab)
-            else:
-                self.doc_graph = None
-        else:
-            self.code_graph = None
-            self.doc_graph = None
+                self.doc_graph_arrays = batch_graph_arrays(batch_doc_graphs, edge_vocab)
+        self._graphs_to_tensors(config)
         for i, (sent1, sent2) in enumerate(instances):
-            src_idx = []
-            for word in sent1.graph['backbone_sequence']:
-                idx = word_vocab.getIndex(word)
-                src_idx.append(idx)
             self.sent1_length.append(sent1.get_token_length())
-            self.sent1_word.append(src_idx)
+            self.sent1_word.append(word_vocab.lookup_many(sent1.graph['backbone_sequence']))
             if sent1.get_token_length() > self.max_sent1_length:
                 self.max_sent1_length = sent1.get_token_length()
             if sent2 is not None:
-                sent2_idx = []
-                for word in sent2.graph['backbone_sequence']:
-                    idx = word_vocab.getIndex(word)
-                    sent2_idx.append(idx)
-                self.sent2_word.append(sent2_idx)
+                self.sent2_word.append(word_vocab.lookup_many(sent2.graph['backbone_sequence']))
                 self.sent2_src.append(' '.join(sent2.graph['backbone_sequence']))
                 self.sent2_length.append(sent2.get_token_length())
             self.code_token_indexes.append(sent1.seq_token_in_node)
@@ -245,6 +430,77 @@ class Batch(object):
             self.sent2_word = padding_utils.pad_2d_vals_no_size(self.sent2_word)
             self.sent2_length = np.array(self.sent2_length, dtype=np.int32)
 
+    def _init_indexed(self, instances, config, word_vocab, edge_vocab):
+        # Same batch as above, built from the id arrays of a columnar dataset
+        self.instances = instances
+        self.batch_size = len(instances)
+        code_graphs = [sent1 for sent1, _ in instances]
+        doc_graphs = [sent2 for _, sent2 in instances if sent2 is not None]
+        self.code_graph_arrays = None
+        self.doc_graph_arrays = None
+        if config['model_name'] in ['Graph2Search']:
+            self.code_graph_arrays = indexed_batch_graph_arrays(code_graphs, word_vocab, edge_vocab)
+            if len(doc_graphs) > 0:
+                self.doc_graph_arrays = indexed_batch_graph_arrays(doc_graphs, word_vocab, edge_vocab)
+        self._graphs_to_tensors(config)
+        self.sent1_word = padding_utils.pad_2d_vals_no_size([g.seq_ids(word_vocab) for g in code_graphs])
+        self.sent1_length = np.array([g.get_token_length() for g in code_graphs], dtype=np.int32)
+        self.max_sent1_length = int(self.sent1_length.max())
+        self.code_token_indexes = [g.seq_token_in_node for g in code_graphs]
+        self.funcs = [g.function for g in code_graphs]
+        self.filenames = [g.filename for g in code_graphs]
+        self.urls = [g.url for g in code_graphs]
+        self.sent2_src = [g.text() for g in doc_graphs]
+        self.sent2_word = []
+        self.sent2_length = []
+        if len(doc_graphs) > 0:
+            self.sent2_word = padding_utils.pad_2d_vals_no_size([g.seq_ids(word_vocab) for g in doc_graphs])
+            self.sent2_length = np.array([g.get_token_length() for g in doc_graphs], dtype=np.int32)
+
+    def _graphs_to_tensors(self, config):
+        self.code_graph = None
+        self.doc_graph = None
+        if self.code_graph_arrays is not None:
+            self.code_graph = batch_graph_to_tensors(self.code_graph_arrays, config['device'])
+        if self.doc_graph_arrays is not None:
+            self.doc_graph = batch_graph_to_tensors(self.doc_graph_arrays, config['device'])
+
+    def save(self, path):
+        """Writes the vectorized batch to `path`.npz (arrays) and `path`.json (strings)."""
+        arrays = {'sent1_word': self.sent1_word, 'sent1_length': self.sent1_length}
+        if len(self.sent2_length) > 0:
+            arrays['sent2_word'] = self.sent2_word
+            arrays['sent2_length'] = self.sent2_length
+        for prefix, graph_arrays in (('code_', self.code_graph_arrays), ('doc_', self.doc_graph_arrays)):
+            if graph_arrays is not None:
+                for name, value in graph_arrays.items():
+                    arrays[prefix + name] = value
+        np.savez(path + '.npz', **arrays)
+        meta = {'batch_size': self.batch_size, 'max_sent1_length': int(self.max_sent1_length),
+                'sent2_src': self.sent2_src, 'code_token_indexes': self.code_token_indexes,
+                'funcs': self.funcs, 'filenames': self.filenames, 'urls': self.urls}
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, config):
+        """Reads a batch written by `save` without touching the vocabs or the raw graphs."""
+        batch = cls.__new__(cls)
+        with open(path + '.json') as f:
+            batch.__dict__.update(json.load(f))
+        batch.instances = None
+        with np.load(path + '.npz') as arrays:
+            arrays = {name: arrays[name] for name in arrays.files}
+        batch.sent1_word = arrays['sent1_word']
+        batch.sent1_length = arrays['sent1_length']
+        batch.sent2_word = arrays.get('sent2_word', [])
+        batch.sent2_length = arrays.get('sent2_length', [])
+        for prefix in ('code_', 'doc_'):
+            graph_arrays = {name[len(prefix):]: value for name, value in arrays.items() if name.startswith(prefix)}
+            setattr(batch, prefix + 'graph_arrays', graph_arrays or None)
+        batch._graphs_to_tensors(config)
+        return batch
+
 
 class Graph(object):
     def __init__(self, instance, codeGraph=False, docGraph=False, isLower=False):
@@ -254,8 +510,9 @@ class Graph(object):
             self.seq_token_in_node = code_graph['seq_token_in_node']
             if isLower:
                 backbone_sequence = [token.lower() for token in backbone_sequence]
-            filter_code_nodes, edges = self.build_code_graph(code_graph, isLower)
-            self.graph = {'nodes': filter_code_nodes, 'edges': edges,
+            filter_code_nodes, edge_types, edge_src, edge_dst = self.build_code_graph(code_graph, isLower)
+            self.graph = {'nodes': filter_code_nodes, 'edge_types': edge_types,
+                          'edge_src': edge_src, 'edge_dst': edge_dst,
                           'backbone_sequence': backbone_sequence}
             if 'original_string' in instance.keys():
                 self.function = instance['original_string']
@@ -273,25 +530,36 @@ class Graph(object):
             if isLower:
                 backbone_sequence = [token.lower() for token in backbone_sequence]
             doc_nodes = self.build_doc_graph(backbone_sequence)
-            self.graph = {'nodes': doc_nodes, 'edges': doc_graph['edges'],
+            edge_types, edge_src, edge_dst = edge_arrays(doc_graph['edges'])
+            self.graph = {'nodes': doc_nodes, 'edge_types': edge_types,
+                          'edge_src': edge_src, 'edge_dst': edge_dst,
                           'backbone_sequence': backbone_sequence}
 
     def build_code_graph(self, code_graph, isLower):
+        """Returns the nodes and the edges between them, as a type list and int64 src / dst arrays."""
         filter_code_nodes = []
-        edges = []
-        node_id_list = []
-        for index, node in enumerate(code_graph['nodes']):
+        for node in code_graph['nodes']:
             if isLower:
                 node_content = node['contents'].lower()
             else:
                 node_content = node['contents']
-            node_id = node['id_sorted']
-            filter_code_nodes.append({'id': node_id, 'content': node_content, 'type': node['type']})
-            node_id_list.append(node_id)
-        for edge in code_graph['edges']:
-            if edge['sourceId'] in node_id_list and edge['destinationId'] in node_id_list:
-                edges.append([edge['type'], edge['sourceId'], edge['destinationId']])
-        return filter_code_nodes, edges
+            filter_code_nodes.append({'id': node['id_sorted'], 'content': node_content, 'type': node['type']})
+        edges = code_graph['edges']
+        edge_src = np.fromiter((edge['sourceId'] for edge in edges), dtype=np.int64, count=len(edges))
+        edge_dst = np.fromiter((edge['destinationId'] for edge in edges), dtype=np.int64, count=len(edges))
+        node_ids = np.fromiter((node['id'] for node in filter_code_nodes), dtype=np.int64, count=len(filter_code_nodes))
+        # Keep edges whose endpoints are both node ids, via a boolean lookup table indexed by id
+        keep = np.zeros(len(edges), dtype=bool)
+        if len(node_ids) and node_ids.min() >= 0:
+            is_node = np.zeros(node_ids.max() + 1, dtype=bool)
+            is_node[node_ids] = True
+            in_range = (edge_src >= 0) & (edge_src < len(is_node)) & (edge_dst >= 0) & (edge_dst < len(is_node))
+            keep[in_range] = is_node[edge_src[in_range]] & is_node[edge_dst[in_range]]
+        elif len(node_ids):
+            keep = np.isin(edge_src, node_ids) & np.isin(edge_dst, node_ids)
+        kept = np.flatnonzero(keep)
+        edge_types = [edges[k]['type'] for k in kept]
+        return filter_code_nodes, edge_types, edge_src[kept], edge_dst[kept]
 
     def build_doc_graph(self, backbone_sequence):
         doc_nodes = []
@@ -302,9 +570,18 @@ class Graph(object):
     def get_node_length(self):
         return len(self.graph['nodes'])
 
+    def get_edge_length(self):
+        return len(self.graph['edge_types'])
+
     def get_token_length(self):
         return len(self.graph['backbone_sequence'])
 
+    def sequence_words(self):
+        return self.graph['backbone_sequence']
+
+    def edge_type_words(self):
+        return self.graph['edge_types']
+
     def subtokenizer(self, identifier):
         splitter_regex = re.compile('.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
         identifiers = re.split('[._\-]', identifier)
@@ -316,36 +593,71 @@ class Graph(object):
         return subtoken_list
 
 
+def edge_arrays(edges):
+    """Splits `[type, src, dst]` edges into a type list and int64 src / dst arrays."""
+    edge_types = [edge[0] for edge in edges]
+    edge_src = np.fromiter((edge[1] for edge in edges), dtype=np.int64, count=len(edges))
+    edge_dst = np.fromiter((edge[2] for edge in edges), dtype=np.int64, count=len(edges))
+    return edge_types, edge_src, edge_dst
+
+
+class BatchIncidence(object):
+    """0/1 incidence matrix of shape (batch_size, num_rows, num_cols) with one non-zero per edge.
+
+    Only the non-zeros are stored, as flat row ids (into batch_size * num_rows) and flat
+    column ids (into batch_size * num_cols), so `bmm` costs O(num_edges * hidden_size)
+    instead of the O(num_edges * num_nodes * hidden_size) of a dense `torch.bmm`.
+    """
+    def __init__(self, row_ids, col_ids, shape):
+        self.row_ids = row_ids
+        self.col_ids = col_ids
+        self.shape = tuple(shape)
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def transpose(self, dim0=1, dim1=2):
+        assert sorted((dim0, dim1)) == [1, 2]
+        batch_size, num_rows, num_cols = self.shape
+        return BatchIncidence(self.col_ids, self.row_ids, (batch_size, num_cols, num_rows))
+
+    def bmm(self, x):
+        """Same result as `torch.bmm(self.to_dense(), x)` for x of shape (batch_size, num_cols, dim)."""
+        batch_size, num_rows, num_cols = self.shape
+        out = x.new_zeros(batch_size * num_rows, x.size(-1))
+        out = out.index_add(0, self.row_ids, x.reshape(batch_size * num_cols, -1).index_select(0, self.col_ids))
+        return out.view(batch_size, num_rows, -1)
+
+    def to_dense(self):
+        batch_size, num_rows, num_cols = self.shape
+        dense = torch.zeros(batch_size * num_rows * num_cols, device=self.row_ids.device)
+        dense[self.row_ids * num_cols + self.col_ids % num_cols] = 1
+        return dense.view(batch_size, num_rows, num_cols)
+
+    def to(self, device):
+        return BatchIncidence(self.row_ids.to(device), self.col_ids.to(device), self.shape)
+
+
 def cons_batch_graph(graphs, word_vocab):
     num_nodes = max([len(g['nodes']) for g in graphs])
-    num_edges = max([len(g['edges']) for g in graphs])
+    num_edges = max([len(g['edge_types']) for g in graphs])
     batch_edges = []
-    batch_node2edge = []
-    batch_edge2node = []
+    batch_edge_src = []
+    batch_edge_dst = []
     batch_node_num = []
     batch_node_index = []
-    for example_id, g in enumerate(graphs):
-        edges = {}
+    for g in graphs:
         graph_node_index = cons_node_features(g['nodes'], word_vocab)
-        node2edge = lil_matrix(np.zeros((num_edges, num_nodes)), dtype=np.float32)
-        edge2node = lil_matrix(np.zeros((num_nodes, num_edges)), dtype=np.float32)
-        edge_index = 0
-        for edge, src_node, dest_node in g['edges']:
-            if src_node == dest_node:  # Ignore self-loops for now
-                continue
-            edges[edge_index] = edge
-            node2edge[edge_index, dest_node] = 1
-            edge2node[src_node, edge_index] = 1
-            edge_index += 1
-        batch_edges.append(edges)
-        batch_node2edge.append(node2edge)
-        batch_edge2node.append(edge2node)
+        keep = np.flatnonzero(g['edge_src'] != g['edge_dst'])  # Ignore self-loops for now
+        batch_edges.append([g['edge_types'][k] for k in keep])
+        batch_edge_src.append(g['edge_src'][keep])
+        batch_edge_dst.append(g['edge_dst'][keep])
         batch_node_num.append(len(g['nodes']))
         batch_node_index.append(graph_node_index)
     batch_graphs = {'max_num_edges': num_edges,
                     'edge_features': batch_edges,
-                    'node2edge': batch_node2edge,
-                    'edge2node': batch_edge2node,
+                    'edge_src': batch_edge_src,    # edge k of graph i goes from node edge_src[i][k]
+                    'edge_dst': batch_edge_dst,    # to node edge_dst[i][k]
                     'node_num': batch_node_num,
                     'max_num_nodes': num_nodes,
                     'node_word_index': batch_node_index
@@ -354,30 +666,82 @@ def cons_batch_graph(graphs, word_vocab):
 
 
 def cons_node_features(nodes, word_vocab):
-    graph_node_index = []
-    for node in nodes:
-        idx = word_vocab.getIndex(node['content'])
-        graph_node_index.append(idx)
-    return graph_node_index
+    return word_vocab.lookup_many([node['content'] for node in nodes])
 
 
 def vectorize_batch_graph(graph, config, edge_vocab):
-    edge_features = []
-    for edges in graph['edge_features']:
-        edges_v = []
-        for idx in range(len(edges)):
-            edges_v.append(edge_vocab.getIndex(edges[idx]))
-        for _ in range(graph['max_num_edges'] - len(edges_v)):
-            edges_v.append(edge_vocab.PAD)
-        edge_features.append(edges_v)
-    edge_features = torch.LongTensor(np.array(edge_features))
-    node_indexes = torch.LongTensor(padding_utils.pad_2d_vals_no_size(graph['node_word_index']))
-    node_num = torch.LongTensor(np.array(graph['node_num']))
-    gv = {'edge_features': edge_features.to(config['device']) if config['device'] else edge_features,
-          'node2edge': graph['node2edge'],
-          'edge2node': graph['edge2node'],
-          'node_num': node_num,
-          'max_node_num_batch': graph['max_num_nodes'],
-          'node_index': node_indexes.to(config['device']) if config['device'] else node_indexes
+    return batch_graph_to_tensors(batch_graph_arrays(graph, edge_vocab), config['device'])
+
+
+def batch_graph_arrays(graph, edge_vocab):
+    """NumPy form of a `cons_batch_graph` batch, which is what the batch cache stores.
+
+    Edge k of graph i is stored once, as flat ids: edge_ids = i * max_num_edges + k,
+    src_ids/dst_ids = i * max_num_nodes + node.
+    """
+    edge_features = np.full((len(graph['edge_features']), graph['max_num_edges']), edge_vocab.PAD, dtype=np.int64)
+    for example_id, edges in enumerate(graph['edge_features']):
+        edge_features[example_id, :len(edges)] = edge_vocab.lookup_many(edges)
+    num_nodes = graph['max_num_nodes']
+    num_edges = graph['max_num_edges']
+    edge_ids = []
+    src_ids = []
+    dst_ids = []
+    for example_id, (edge_src, edge_dst) in enumerate(zip(graph['edge_src'], graph['edge_dst'])):
+        edge_ids.append(np.arange(len(edge_src), dtype=np.int64) + example_id * num_edges)
+        src_ids.append(np.asarray(edge_src, dtype=np.int64) + example_id * num_nodes)
+        dst_ids.append(np.asarray(edge_dst, dtype=np.int64) + example_id * num_nodes)
+    return {'edge_features': edge_features,
+            'node_index': padding_utils.pad_2d_vals_no_size(graph['node_word_index']),
+            'node_num': np.array(graph['node_num'], dtype=np.int64),
+            'edge_ids': np.concatenate(edge_ids).astype(np.int64),
+            'src_ids': np.concatenate(src_ids).astype(np.int64),
+            'dst_ids': np.concatenate(dst_ids).astype(np.int64),
+            'max_num_nodes': np.int64(num_nodes),
+            'max_num_edges': np.int64(num_edges)}
+
+
+def indexed_batch_graph_arrays(graphs, word_vocab, edge_vocab):
+    """`batch_graph_arrays(cons_batch_graph(...))` for IndexedGraphs, without any per-token Python work."""
+    num_nodes = max(g.get_node_length() for g in graphs)
+    num_edges = max(len(g.edge_types) for g in graphs)
+    edge_features = np.full((len(graphs), num_edges), edge_vocab.PAD, dtype=np.int64)
+    node_index = np.zeros((len(graphs), num_nodes), dtype=np.int32)
+    edge_ids = []
+    src_ids = []
+    dst_ids = []
+    for example_id, g in enumerate(graphs):
+        node_index[example_id, :g.get_node_length()] = g.node_ids(word_vocab)
+        keep = g.edge_src != g.edge_dst  # Ignore self-loops for now
+        num_kept = int(keep.sum())
+        edge_features[example_id, :num_kept] = g.edge_type_ids(edge_vocab)[keep]
+        edge_ids.append(np.arange(num_kept, dtype=np.int64) + example_id * num_edges)
+        src_ids.append(g.edge_src[keep].astype(np.int64) + example_id * num_nodes)
+        dst_ids.append(g.edge_dst[keep].astype(np.int64) + example_id * num_nodes)
+    return {'edge_features': edge_features,
+            'node_index': node_index,
+            'node_num': np.array([g.get_node_length() for g in graphs], dtype=np.int64),
+            'edge_ids': np.concatenate(edge_ids),
+            'src_ids': np.concatenate(src_ids),
+            'dst_ids': np.concatenate(dst_ids),
+            'max_num_nodes': np.int64(num_nodes),
+            'max_num_edges': np.int64(num_edges)}
+
+
+def batch_graph_to_tensors(arrays, device=None):
+    batch_size = len(arrays['node_num'])
+    num_nodes = int(arrays['max_num_nodes'])
+    num_edges = int(arrays['max_num_edges'])
+    edge_ids, src_ids, dst_ids = [torch.from_numpy(np.asarray(arrays[name])).to(device)
+                                  for name in ('edge_ids', 'src_ids', 'dst_ids')]
+    edge_features = torch.LongTensor(np.asarray(arrays['edge_features']))
+    node_indexes = torch.LongTensor(np.asarray(arrays['node_index']))
+    gv = {'edge_features': edge_features.to(device) if device else edge_features,
+          # node2edge[i, k, dst] = 1 and edge2node[i, src, k] = 1 for edge k of graph i
+          'node2edge': BatchIncidence(edge_ids, dst_ids, (batch_size, num_edges, num_nodes)),
+          'edge2node': BatchIncidence(src_ids, edge_ids, (batch_size, num_nodes, num_edges)),
+          'node_num': torch.LongTensor(np.asarray(arrays['node_num'])),
+          'max_node_num_batch': num_nodes,
+          'node_index': node_indexes.to(device) if device else node_indexes
           }
-    return gv
\ No newline at end of file
+    return gv
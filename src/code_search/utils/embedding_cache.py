@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Module to cache query embeddings between searches.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from . import constants as Constants
+from .generic_utils import file_sha1
+
+
+def checkpoint_fingerprint(saved_dir, filename=Constants._SAVED_WEIGHTS_FILE):
+    """Returns the sha1 of the saved weights file in `saved_dir`.
+
+    A checkpoint that is overwritten in place gets a new fingerprint.
+    """
+    return file_sha1(os.path.join(saved_dir, filename))
+
+
+class QueryEmbeddingCache(object):
+    """LRU cache of float32 query embeddings with a TTL and a memory cap.
+
+    Entries are keyed by `(model_key, query)`, where `model_key` identifies the
+    checkpoint the embedding came from, so embeddings of another checkpoint are
+    never returned. Thread safe.
+    """
+    # Rough per-entry bookkeeping cost on top of the vector and the query text
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, model_key, max_mb=64, ttl=3600):
+        self.model_key = model_key
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry_size(self, key, vector):
+        return vector.nbytes + len(key[1]) + self.ENTRY_OVERHEAD
+
+    def get(self, query):
+        key = (self.model_key, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, query, vector):
+        key = (self.model_key, query)
+        vector = np.array(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (vector, time.monotonic())
+            self.num_bytes += self._entry_size(key, vector)
+            while self.num_bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        vector, _ = self._entries.pop(key)
+        self.num_bytes -= self._entry_size(key, vector)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+                'mb': self.num_bytes / (1024. * 1024.), 'hit_rate': self.hits / total if total else 0.}
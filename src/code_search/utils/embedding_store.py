@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Module for the on-disk, memory-mapped store of code vectors written by `build --local`.
+
+Layout of a store directory:
+    vectors.npy             (num_vectors, dim) float32/float16, opened with mmap_mode='r'
+    norms.npy               (num_vectors,) float32 L2 norms of the vectors
+    <column>.bin            utf-8 bytes of every value of a metadata column, back to back
+    <column>.offsets.npy    (num_vectors + 1,) int64; value i is bin[offsets[i]: offsets[i + 1]]
+    store.json              number of vectors, dimension and dtype
+"""
+import os
+import json
+import numpy as np
+
+
+METADATA_COLUMNS = ['code_func', 'identifier', 'url']
+
+
+class EmbeddingStoreWriter(object):
+    """Streams code vectors and their metadata into an `EmbeddingStore` directory."""
+    def __init__(self, dirname, dtype='float32'):
+        self.dirname = dirname
+        self.dtype = np.dtype(dtype)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.num_vectors = 0
+        self.dim = None
+        self._raw_vectors = open(os.path.join(dirname, 'vectors.raw'), 'wb')
+        self._norms = []
+        self._blobs = {}
+        self._offsets = {}
+        for column in METADATA_COLUMNS:
+            self._blobs[column] = open(os.path.join(dirname, column + '.bin'), 'wb')
+            self._offsets[column] = [0]
+
+    def __len__(self):
+        return self.num_vectors
+
+    def add(self, code_states, code_funcs, file_names, code_urls):
+        if len(code_states) == 0:
+            return
+        code_states = np.asarray(code_states, dtype=np.float32)
+        if self.dim is None:
+            self.dim = code_states.shape[1]
+        self._raw_vectors.write(code_states.astype(self.dtype).tobytes())
+        self._norms.append(np.linalg.norm(code_states, axis=1))
+        for column, values in zip(METADATA_COLUMNS, (code_funcs, file_names, code_urls)):
+            blob = self._blobs[column]
+            offsets = self._offsets[column]
+            for value in values:
+                data = (value or '').encode('utf-8')
+                blob.write(data)
+                offsets.append(offsets[-1] + len(data))
+        self.num_vectors += code_states.shape[0]
+
+    def close(self, chunk_size=65536):
+        self._raw_vectors.close()
+        for column in METADATA_COLUMNS:
+            self._blobs[column].close()
+            np.save(os.path.join(self.dirname, column + '.offsets.npy'), np.array(self._offsets[column], dtype=np.int64))
+        raw_path = os.path.join(self.dirname, 'vectors.raw')
+        dim = self.dim or 0
+        # Re-wrap the raw rows as a regular .npy file so both np.load(mmap_mode='r') and np.memmap can open it
+        vectors = np.lib.format.open_memmap(os.path.join(self.dirname, 'vectors.npy'), mode='w+',
+                                            dtype=self.dtype, shape=(self.num_vectors, dim))
+        raw = np.memmap(raw_path, dtype=self.dtype, mode='r', shape=(self.num_vectors, dim)) \
+            if self.num_vectors else np.empty((0, dim), dtype=self.dtype)
+        for start in range(0, self.num_vectors, chunk_size):
+            vectors[start: start + chunk_size] = raw[start: start + chunk_size]
+        vectors.flush()
+        del vectors, raw
+        os.remove(raw_path)
+        norms = np.concatenate(self._norms) if self._norms else np.empty(0)
+        np.save(os.path.join(self.dirname, 'norms.npy'), norms.astype(np.float32))
+        with open(os.path.join(self.dirname, 'store.json'), 'w') as f:
+            json.dump({'num_vectors': self.num_vectors, 'dim': dim, 'dtype': self.dtype.name}, f)
+
+
+class EmbeddingStore(object):
+    """Read-only, zero-copy view of a store written by `EmbeddingStoreWriter`.
+
+    Opening only maps the files, so it takes milliseconds whatever the corpus size
+    and every process on the host shares the same page cache.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'store.json')) as f:
+            info = json.load(f)
+        self.dim = info['dim']
+        self.vectors = np.load(os.path.join(dirname, 'vectors.npy'), mmap_mode='r')
+        self.norms = np.load(os.path.join(dirname, 'norms.npy'), mmap_mode='r')
+        self._blobs = {}
+        self._offsets = {}
+        for column in METADATA_COLUMNS:
+            blob_path = os.path.join(dirname, column + '.bin')
+            if os.path.getsize(blob_path) > 0:
+                self._blobs[column] = np.memmap(blob_path, dtype=np.uint8, mode='r')
+            else:
+                self._blobs[column] = np.empty(0, dtype=np.uint8)
+            self._offsets[column] = np.load(os.path.join(dirname, column + '.offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def get_text(self, column, i):
+        offsets = self._offsets[column]
+        return self._blobs[column][offsets[i]: offsets[i + 1]].tobytes().decode('utf-8')
+
+    def get_metadata(self, i):
+        return {'function': self.get_text('code_func', i), 'identifier': self.get_text('identifier', i),
+                'url': self.get_text('url', i)}
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Module that owns the Elasticsearch clients shared by the search and index build paths.
+"""
+import os
+import threading
+from elasticsearch import Elasticsearch
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def es_client_settings(config=None):
+    config = config or {}
+    return (config.get('es_endpoint') or os.getenv('ELASTIC_ENDPOINT'),
+            config.get('es_api_key') or os.getenv('ELASTIC_API_KEY'),
+            config.get('es_pool_size', 10),
+            config.get('es_timeout', 30),
+            config.get('es_max_retries', 3),
+            config.get('es_retry_on_timeout', True))
+
+
+def get_es_client(config=None):
+    """Returns the process-wide client for the endpoint and settings in `config`.
+
+    The client is created on first use and then reused, so its keep-alive
+    connection pool (and the TLS handshake behind it) is set up once per process.
+    Config keys: 'es_endpoint' and 'es_api_key' (default to the ELASTIC_ENDPOINT
+    and ELASTIC_API_KEY environment variables), 'es_pool_size', 'es_timeout',
+    'es_max_retries' and 'es_retry_on_timeout'.
+    """
+    settings = es_client_settings(config)
+    with _CLIENTS_LOCK:
+        if settings not in _CLIENTS:
+            endpoint, api_key, pool_size, timeout, max_retries, retry_on_timeout = settings
+            _CLIENTS[settings] = Elasticsearch(endpoint,
+                                               api_key=api_key,
+                                               connections_per_node=pool_size,
+                                               request_timeout=timeout,
+                                               max_retries=max_retries,
+                                               retry_on_timeout=retry_on_timeout)
+        return _CLIENTS[settings]
+
+
+def close_es_clients():
+    with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
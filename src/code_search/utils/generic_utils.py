@@ -2,6 +2,7 @@ import yaml
 import shlex
 import subprocess
 import os
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
@@ -69,12 +70,26 @@ def to_cuda(x, device=None):
     return x
 
 
+_FILE_HASHES = {}
+
+
+def file_sha1(path):
+    """sha1 of the file contents, memoised per (path, size, mtime)."""
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if signature not in _FILE_HASHES:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        _FILE_HASHES[signature] = sha1.hexdigest()
+    return _FILE_HASHES[signature]
+
+
 def create_mask(x, N, device=None):
-    x = x.data
-    mask = np.zeros((x.size(0), N))
-    for i in range(x.size(0)):
-        mask[i, :x[i]] = 1
-    return to_cuda(torch.Tensor(mask), device)
+    # mask[i, j] = 1 for j < x[i], built on the device with one comparison
+    x = to_cuda(x.detach(), device)
+    return (torch.arange(N, device=x.device).unsqueeze(0) < x.unsqueeze(1)).float()
 
 
 def get_config(config_path="config.yml"):
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Module to run the query encoder exported to ONNX (encoders.export_query_onnx) with onnxruntime.
+
+It only needs NumPy: the inputs are the arrays of `batch_graph_arrays` plus the padded
+query word ids, and the output is the float32 query embeddings.
+"""
+import numpy as np
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+# Graph inputs of the exported model, in order; all int64
+ONNX_INPUTS = ('targets', 'target_lens', 'edge_features', 'edge_ids', 'src_ids', 'dst_ids')
+
+
+class OnnxQueryEncoder(object):
+    """Embeds query batches with an onnxruntime CPU session."""
+    def __init__(self, path, num_threads=0):
+        if onnxruntime is None:
+            raise RuntimeError('The onnx query encoder backend needs the onnxruntime package')
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        # A 'global' des_info_type model does not read the graph edges, so they may not be graph inputs
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def __call__(self, arrays):
+        """arrays: dict with the ONNX_INPUTS, e.g. `batch_graph_arrays(...)` plus targets / target_lens."""
+        feed = {name: np.asarray(arrays[name], dtype=np.int64) for name in self.input_names}
+        return self.session.run(None, feed)[0]
@@ -6,6 +6,26 @@ def make_batches(size, batch_size):
     return [(i*batch_size, min(size, (i+1)*batch_size)) for i in range(0, nb_batch)]
 
 
+def make_budget_batches(sizes, batch_size, budget):
+    """Spans of consecutive (num_nodes, num_edges) `sizes`, each holding at most batch_size
+    examples and, unless a single example exceeds it, at most `budget` padded
+    batch x max_nodes x max_edges slots."""
+    spans = []
+    start = 0
+    max_nodes = max_edges = 0
+    for i, (num_nodes, num_edges) in enumerate(sizes):
+        new_nodes = max(max_nodes, num_nodes, 1)
+        new_edges = max(max_edges, num_edges, 1)
+        if i > start and (i - start >= batch_size or (i - start + 1) * new_nodes * new_edges > budget):
+            spans.append((start, i))
+            start = i
+            new_nodes, new_edges = max(num_nodes, 1), max(num_edges, 1)
+        max_nodes, max_edges = new_nodes, new_edges
+    if start < len(sizes):
+        spans.append((start, len(sizes)))
+    return spans
+
+
 def pad_2d_vals_no_size(in_vals, dtype=np.int32):
     size1 = len(in_vals)
     size2 = np.max([len(x) for x in in_vals])
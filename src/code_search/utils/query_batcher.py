@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Module to embed queries from concurrent callers in shared forward passes.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+
+class QueryBatcher(object):
+    """Dynamic micro-batching scheduler in front of the query encoder.
+
+    Callers hand over their query graphs and block. A single worker thread takes the
+    first pending request, keeps collecting requests for at most `max_wait_ms` or until
+    `max_batch_size` queries are queued, runs `embed_fn` once on all of them and hands
+    every caller back its own rows. `embed_fn` maps a list of query `Graph`s to an
+    array of shape (num_queries, dim), so the model is only ever touched by the worker.
+    """
+    def __init__(self, embed_fn, max_batch_size=32, max_wait_ms=5):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.pending = queue.Queue()
+        self.num_batches = 0
+        self.num_queries = 0
+        self.worker = threading.Thread(target=self._run, name='query-batcher', daemon=True)
+        self.worker.start()
+
+    def embed(self, instances):
+        future = Future()
+        self.pending.put((instances, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.pending.get()]
+        num_queries = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while num_queries < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            num_queries += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            instances = [instance for item, _ in batch for instance in item]
+            try:
+                vectors = self.embed_fn(instances)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_queries += len(instances)
+            start = 0
+            for item, future in batch:
+                future.set_result(np.asarray(vectors[start: start + len(item)]))
+                start += len(item)
+
+    def mean_batch_size(self):
+        return self.num_queries / self.num_batches if self.num_batches else 0.
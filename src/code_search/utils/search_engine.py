@@ -1,156 +1,344 @@
 import os
 print(os.getcwd())
-from graph_gen.build_java_graph import build_desc_graph, normalize_des_graph
-from utils.data_utils import Graph, cons_batch_graph, vectorize_batch_graph
+from graph_gen.build_java_graph import build_desc_graph, normalize_des_graph, DescGraphCache
+from utils.data_utils import Graph, cons_batch_graph, batch_graph_arrays, batch_graph_to_tensors
 from utils.padding_utils import pad_2d_vals_no_size
-from model import cal_query_features
+from encoders import QueryEncoder, QUERY_ENCODER_FILE, QUERY_ONNX_FILE, VOCAB_DIR, inference_device, load_encoder, \
+    quantize_dynamic_int8
+from utils.onnx_query_encoder import OnnxQueryEncoder
+from utils.vocab_utils import VocabModel
 from utils import constants
+from utils.vector_index import VectorIndex
+from utils.embedding_store import EmbeddingStore
+from utils.es_client import get_es_client
+from utils.query_batcher import QueryBatcher
+from utils.embedding_cache import QueryEmbeddingCache, checkpoint_fingerprint
 import numpy as np
 import torch
-from elasticsearch import Elasticsearch
 import pandas as pd
 import os
+import threading
+
+
+class ElasticBackend(object):
+    """Scores every document of the Elasticsearch index with a `script_score` query."""
+    def __init__(self, config):
+        self.config = config
+        self.client = get_es_client(config)
+        self.msearch_size = config.get('es_msearch_size', 256)
+
+    def build_query(self, query_vector, search_size):
+        script_query = {
+            "script_score": {
+                "query": {"match_all": {}},
+                "script": {
+                    # "source": "cosineSimilarity(params.query_vector, doc['code_state']) + 1.0",
+                    "source": "cosineSimilarity(params.query_vector, 'code_state') + 1.0",
+                    "params": {"query_vector": query_vector.tolist()}
+                }
+            }
+        }
+        return {
+            "size": search_size,
+            "query": script_query,
+            "_source": {"includes": ['code_func', 'identifier', 'url']}
+        }
+
+    def parse_response(self, response):
+        hits = []
+        for hit in response["hits"]["hits"]:
+            hits.append({'function': hit["_source"]['code_func'], 'identifier': hit["_source"]['identifier'],
+                         'url': hit["_source"]['url'], 'score': hit['_score']})
+        return hits, response['hits']['total']['value'], response['hits']['max_score']
+
+    def search(self, query_vector, search_size):
+        response = self.client.search(index=self.config['index_name'], body=self.build_query(query_vector, search_size))
+        return self.parse_response(response)
+
+    def search_batch(self, query_vectors, search_size):
+        """Sends up to `es_msearch_size` queries per `_msearch` round trip."""
+        results = []
+        for start in range(0, len(query_vectors), self.msearch_size):
+            body = []
+            for query_vector in query_vectors[start: start + self.msearch_size]:
+                body.append({'index': self.config['index_name']})
+                body.append(self.build_query(query_vector, search_size))
+            response = self.client.msearch(body=body)
+            for item in response['responses']:
+                if 'error' in item:
+                    raise RuntimeError('msearch failed: {}'.format(item['error']))
+                results.append(self.parse_response(item))
+        return results
+
+
+class ANNBackend(object):
+    """Searches an in-process IVF index built by `build --only-database` with `vector_backend: ann`."""
+    def __init__(self, config):
+        self.config = config
+        self.index = VectorIndex.load(config['ann_index_dir'], nprobe=config.get('ann_nprobe', None))
+
+    def search(self, query_vector, search_size):
+        return self.search_batch(np.atleast_2d(query_vector), search_size)[0]
+
+    def search_batch(self, query_vectors, search_size):
+        all_scores, all_ids = self.index.search(query_vectors, search_size)
+        results = []
+        for scores, ids in zip(all_scores, all_ids):
+            hits = []
+            for score, i in zip(scores, ids):
+                if i < 0:
+                    continue
+                hit = self.index.get_metadata(i)
+                hit['score'] = float(score)
+                hits.append(hit)
+            results.append((hits, len(self.index), hits[0]['score'] if hits else None))
+        return results
+
+
+class LocalBackend(object):
+    """Exact cosine search over the memory-mapped store written by `build --local`."""
+    def __init__(self, config):
+        self.config = config
+        self.store = EmbeddingStore(config['local_index_dir'])
+        self.chunk_size = config.get('local_search_chunk_size', 262144)
+
+    def search(self, query_vector, search_size):
+        return self.search_batch(np.atleast_2d(query_vector), search_size)[0]
+
+    def search_batch(self, query_vectors, search_size):
+        """Scores all queries against each chunk of the store with one matrix product."""
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        query_norms = np.maximum(np.linalg.norm(query_vectors, axis=1, keepdims=True), constants.VERY_SMALL_NUMBER)
+        query_vectors = (query_vectors / query_norms).astype(self.store.vectors.dtype)
+        num_queries = query_vectors.shape[0]
+        best_scores = np.empty((num_queries, 0), dtype=np.float32)
+        best_ids = np.empty((num_queries, 0), dtype=np.int64)
+        for start in range(0, len(self.store), self.chunk_size):
+            end = min(start + self.chunk_size, len(self.store))
+            norms = np.maximum(self.store.norms[start: end], constants.VERY_SMALL_NUMBER)
+            scores = (query_vectors @ self.store.vectors[start: end].T).astype(np.float32) / norms
+            top = min(search_size, end - start)
+            ids = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, ids, axis=1)], axis=1)
+            best_ids = np.concatenate([best_ids, ids + start], axis=1)
+        order = np.argsort(-best_scores, axis=1)[:, :search_size]
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        results = []
+        for scores, ids in zip(best_scores, best_ids):
+            hits = []
+            for score, i in zip(scores, ids):
+                hit = self.store.get_metadata(i)
+                hit['score'] = float(score) + 1.0
+                hits.append(hit)
+            results.append((hits, len(self.store), hits[0]['score'] if hits else None))
+        return results
+
+
+VECTOR_BACKENDS = {'elastic': ElasticBackend, 'ann': ANNBackend, 'local': LocalBackend}
+
+
+def get_vector_backend(config):
+    backend = config.get('vector_backend', 'elastic')
+    if backend not in VECTOR_BACKENDS:
+        raise RuntimeError('Unknown vector_backend: {}'.format(backend))
+    return VECTOR_BACKENDS[backend](config)
 
 
 class search_engine:
+    """Embeds queries and searches the vector backend.
+
+    Pass model_handle=None to load only the query encoder exported to
+    config['query_encoder_dir'] (see encoders.export_encoders) instead of the full model;
+    with 'query_encoder_backend: onnx' it is run by onnxruntime from query_encoder.onnx.
+    """
     def __init__(self, model_handle, config):
-        self.model = model_handle.model
         self.config = config
-        self.model_handle = model_handle
+        if model_handle is not None:
+            # Queries are only ever embedded, so keep dropout off
+            model_handle.model.network.train(False)
+            self.query_encoder = QueryEncoder.from_network(model_handle.model.network)
+            self.vocab_model = model_handle.model.vocab_model
+            self.device = model_handle.device
+            self.model_dir, self.model_file = config.get('pretrained'), constants._SAVED_WEIGHTS_FILE
+        elif config.get('query_encoder_backend', 'torch') == 'onnx':
+            self.device = None
+            self.query_encoder = OnnxQueryEncoder(os.path.join(config['query_encoder_dir'], QUERY_ONNX_FILE),
+                                                  num_threads=config.get('onnx_threads', 0))
+            self.vocab_model = VocabModel.load(os.path.join(config['query_encoder_dir'], VOCAB_DIR))
+            self.model_dir, self.model_file = config['query_encoder_dir'], QUERY_ONNX_FILE
+        else:
+            self.device = inference_device(config)
+            self.query_encoder, self.vocab_model = load_encoder(config['query_encoder_dir'], 'query', self.device)
+            if config.get('quantize_int8', False) and self.device.type == 'cpu':
+                self.query_encoder = quantize_dynamic_int8(self.query_encoder)
+            self.model_dir, self.model_file = config['query_encoder_dir'], QUERY_ENCODER_FILE
+        self.backend = get_vector_backend(config)
+        # spaCy pipelines are not safe to call from several threads at once
+        self.parse_lock = threading.Lock()
+        self.desc_graph_cache = DescGraphCache(maxsize=config.get('desc_graph_cache_size', 10000),
+                                               path=config.get('desc_graph_cache_file', None))
+        self.batcher = None
+        if config.get('query_batching', False):
+            self.batcher = QueryBatcher(self._embed_instances, max_batch_size=config.get('query_batch_size', 32),
+                                        max_wait_ms=config.get('query_batch_wait_ms', 5))
+        self.embedding_cache = None
+        if self.model_dir and config.get('query_embedding_cache_mb', 64) > 0:
+            # Fingerprint of the checkpoint just loaded; fixed for the life of the in-memory model, so
+            # a checkpoint replaced on disk never gets embeddings of these weights under its key
+            self.embedding_cache = QueryEmbeddingCache(checkpoint_fingerprint(self.model_dir, self.model_file),
+                                                       max_mb=config.get('query_embedding_cache_mb', 64),
+                                                       ttl=config.get('query_embedding_cache_ttl', 3600))
         self.save_file = config['answer_file']
         if not os.path.exists(os.path.dirname(self.save_file)):
             os.makedirs(os.path.dirname(self.save_file))
 
     def search(self, str_searchs, search_size=10):
-        instances = []
         answers = []
-        for str_search in str_searchs:
-            instance = {}
-            str_search = ' '.join(str_search)
-            instance['doc_graph'] = build_desc_graph(str_search, file=None)
-            instance['doc_graph'] = normalize_des_graph(instance['doc_graph'])
-            instances.append(Graph(instance, docGraph=True, isLower='True'))
-        ex = self.build_batch_data(instances)
-        query_embedded = cal_query_features(self.model.network, ex)
-        client = Elasticsearch(
-            os.getenv('ELASTIC_ENDPOINT'),
-            api_key = os.getenv('ELASTIC_API_KEY'),
-        )
-        for index in range(query_embedded.shape[0]): 
-            script_query = {
-                "script_score": {
-                    "query": {"match_all": {}},
-                    "script": {
-                        # "source": "cosineSimilarity(params.query_vector, doc['code_state']) + 1.0",
-                        "source": "cosineSimilarity(params.query_vector, 'code_state') + 1.0",
-                        "params": {"query_vector": query_embedded[index].tolist()}
-                    }
-                }
-            }
-
-            response = client.search(index=self.config['index_name'], body={
-                    "size": search_size,
-                    "query": script_query,
-                    "_source": {"includes": ['code_func', 'identifier', 'url']}
-                }
-            )
-            for hit in response["hits"]["hits"]:
-                answers.append({'query': ' '.join(str_searchs[index]), 'function': hit["_source"]['code_func'],
-                                'identifier': hit["_source"]['identifier'], 'url': hit["_source"]['url'],
-                                'score': hit['_score']})
+        queries = [' '.join(str_search) for str_search in str_searchs]
+        # Embed in test-sized batches, then score every query in one batched backend call
+        batch_size = self.config.get('test_batch_size', len(queries))
+        query_embedded = []
+        for start in range(0, len(queries), batch_size):
+            query_embedded.append(self.embed_queries(queries[start: start + batch_size]))
+        query_embedded = np.concatenate(query_embedded, axis=0)
+        results = self.backend.search_batch(query_embedded, search_size)
+        for index, (hits, _, _) in enumerate(results):
+            for hit in hits:
+                hit['query'] = ' '.join(str_searchs[index])
+                answers.append(hit)
         df = pd.DataFrame(answers, columns=['query', 'function', 'identifier', 'url', 'score'])
         df.to_csv(self.save_file, index=False)
+        self.save_caches()
         print('Answer query finished')
 
     def search_single_query(self, query, search_size=10):
-        # Prepare the query
-        instance = {}
-        instance['doc_graph'] = build_desc_graph(query, file=None)
-        instance['doc_graph'] = normalize_des_graph(instance['doc_graph'])
-        instance = Graph(instance, docGraph=True, isLower='True')
-
-        # Embed the query
-        ex = self.build_batch_data([instance])
-        query_embedded = cal_query_features(self.model.network, ex)
-
-        # Set up Elasticsearch client
-        client = Elasticsearch(
-            os.getenv('ELASTIC_ENDPOINT'),
-            api_key=os.getenv('ELASTIC_API_KEY'),
-        )
+        return self.search_queries([query], [search_size])[0]
 
-        # Prepare the script query
-        script_query = {
-            "script_score": {
-                "query": {"match_all": {}},
-                "script": {
-                    "source": "cosineSimilarity(params.query_vector, 'code_state') + 1.0",
-                    "params": {"query_vector": query_embedded[0].tolist()}
-                }
-            }
-        }
+    def search_queries(self, queries, search_sizes=10):
+        """Answers several queries with one embedding pass and one batched backend call.
+
+        Returns a `search_single_query` style response for every query, in order.
+        """
+        if not isinstance(search_sizes, (list, tuple)):
+            search_sizes = [search_sizes] * len(queries)
+        search_sizes = [search_size or 10 for search_size in search_sizes]
+
+        query_embedded = self.embed_queries(queries)
 
         # Perform the search
-        response = client.search(index=self.config['index_name'], body={
-            "size": search_size,
-            "query": script_query,
-            "_source": {"includes": ['code_func', 'identifier', 'url']}
-        })
+        backend_results = self.backend.search_batch(query_embedded, max(search_sizes))
 
-        # Prepare the results
-        results = []
-        for hit in response["hits"]["hits"]:
-            result = {
+        responses = []
+        for query, search_size, (hits, total_hits, max_score) in zip(queries, search_sizes, backend_results):
+            # Prepare the results
+            results = []
+            for hit in hits[:search_size]:
+                result = {
+                    'query': query,
+                    'function': hit['function'],
+                    'identifier': hit['identifier'],
+                    'url': hit['url'],
+                    'score': hit['score']
+                }
+                results.append(result)
+
+            # Prepare the final response
+            final_response = {
                 'query': query,
-                'function': hit["_source"]['code_func'],
-                'identifier': hit["_source"]['identifier'],
-                'url': hit["_source"]['url'],
-                'score': hit['_score']
+                'results': results,
+                'total_hits': total_hits,
+                'max_score': max_score
             }
-            results.append(result)
-
-        # Prepare the final response
-        final_response = {
-            'query': query,
-            'results': results,
-            'total_hits': response['hits']['total']['value'],
-            'max_score': response['hits']['max_score']
-        }
+            responses.append(final_response)
 
-        return final_response
-    
-    def build_batch_data(self, instances):
+        return responses
+
+    def embed_queries(self, queries):
+        """Returns the float32 embeddings of `queries`, one row per query.
+
+        Queries found in the embedding cache skip both the parse and the network.
+        """
+        cache = self.embedding_cache
+        keys = [DescGraphCache.normalize_key(query) for query in queries]
+        query_embedded = [cache.get(key) if cache is not None else None for key in keys]
+        missing = [index for index, vector in enumerate(query_embedded) if vector is None]
+        if missing:
+            # Prepare the queries
+            instances = []
+            for index in missing:
+                instance = {}
+                instance['doc_graph'] = self.build_query_graph(queries[index])
+                instances.append(Graph(instance, docGraph=True, isLower='True'))
+
+            # Embed the queries, sharing a forward pass with concurrent callers when batching is on
+            if self.batcher is not None:
+                vectors = self.batcher.embed(instances)
+            else:
+                vectors = self._embed_instances(instances)
+            for index, vector in zip(missing, vectors):
+                query_embedded[index] = vector
+                if cache is not None:
+                    cache.put(keys[index], vector)
+        return np.stack(query_embedded).astype(np.float32, copy=False)
+
+    def build_query_graph(self, query):
+        doc_graph = self.desc_graph_cache.get(query)
+        if doc_graph is None:
+            with self.parse_lock:
+                doc_graph = build_desc_graph(query, file=None)
+            doc_graph = normalize_des_graph(doc_graph)
+            self.desc_graph_cache.put(query, doc_graph)
+        return doc_graph
+
+    def cache_stats(self):
+        stats = {'desc_graph': self.desc_graph_cache.stats()}
+        if self.embedding_cache is not None:
+            stats['query_embedding'] = self.embedding_cache.stats()
+        return stats
+
+    def save_caches(self):
+        if self.desc_graph_cache.path:
+            self.desc_graph_cache.save()
+
+    def _embed_instances(self, instances):
+        if isinstance(self.query_encoder, OnnxQueryEncoder):
+            return self.query_encoder(self.build_query_arrays(instances))
+        with torch.no_grad():
+            ex = self.build_batch_data(instances)
+            return self.query_encoder(ex).cpu().numpy()
+
+    def build_query_arrays(self, instances):
+        """NumPy batch of query graphs: `batch_graph_arrays` plus the padded word ids ('targets', 'target_lens')."""
         doc_word_lengths = []
         doc_words = []
         doc_graphs = []
         for i, doc_graph in enumerate(instances):
-            doc_idx = []
-            for word in doc_graph.graph['backbone_sequence']:
-                idx = self.model.vocab_model.word_vocab.getIndex(word)
-                doc_idx.append(idx)
+            doc_idx = self.vocab_model.word_vocab.lookup_many(doc_graph.graph['backbone_sequence'])
             doc_word_lengths.append(len(doc_idx))
             doc_words.append(doc_idx)
             doc_graphs.append(doc_graph.graph)
-        batch_doc_graphs = cons_batch_graph(doc_graphs, self.model.vocab_model.word_vocab)
-        doc_words = pad_2d_vals_no_size(doc_words)
-        doc_word_lengths = np.array(doc_word_lengths, dtype=np.int32)
-        doc_words = torch.LongTensor(doc_words)
-        doc_word_lengths = torch.LongTensor(doc_word_lengths)
-        batch_doc_graphs = vectorize_batch_graph(batch_doc_graphs, self.config, self.model.vocab_model.edge_vocab)
+        batch_doc_graphs = cons_batch_graph(doc_graphs, self.vocab_model.word_vocab)
+        arrays = batch_graph_arrays(batch_doc_graphs, self.vocab_model.edge_vocab)
+        arrays['targets'] = pad_2d_vals_no_size(doc_words)
+        arrays['target_lens'] = np.array(doc_word_lengths, dtype=np.int64)
+        return arrays
+
+    def build_batch_data(self, instances):
+        arrays = self.build_query_arrays(instances)
+        doc_words = torch.LongTensor(arrays['targets'])
+        doc_word_lengths = torch.LongTensor(arrays['target_lens'])
+        batch_doc_graphs = batch_graph_to_tensors(arrays, self.device)
         with torch.set_grad_enabled(False):
             example = {'batch_size': len(instances),
                        'doc_graphs': batch_doc_graphs,
-                       'targets': doc_words.to(self.model_handle.device) if self.model_handle.device else doc_words,
-                       'target_lens': doc_word_lengths.to(self.model_handle.device) if self.model_handle.device
-                       else doc_word_lengths
+                       'targets': doc_words.to(self.device) if self.device else doc_words,
+                       'target_lens': doc_word_lengths.to(self.device) if self.device else doc_word_lengths
                        }
         return example
 
     def test(self, query_embedded):
-        client = Elasticsearch(
-            os.getenv('ELASTIC_ENDPOINT'),
-            api_key = os.getenv('ELASTIC_API_KEY'),
-        )
+        client = get_es_client(self.config)
         script_query = {
             "script_score": {
                 "query": {"match_all": {}},
@@ -171,4 +359,14 @@ class search_engine:
         for hit in response["hits"]["hits"]:
             print("score: {}".format(hit["_score"]))
             print(hit["_source"]['code_func'])
-            print('--------------------------')
\ No newline at end of file
+            print('--------------------------')
+
+
+def load_search_engine(config):
+    """search_engine over the query encoder exported to 'query_encoder_dir' if set, else over the 'pretrained' model."""
+    if config.get('query_encoder_dir'):
+        return search_engine(model_handle=None, config=config)
+    if not os.path.exists(config['pretrained']):
+        raise ValueError('pretrained model not found: {}'.format(config['pretrained']))
+    from model_handler_extend import ModelHandlerExtend
+    return search_engine(model_handle=ModelHandlerExtend(config), config=config)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Module for in-process approximate nearest neighbour search over code vectors.
+"""
+import os
+import json
+import numpy as np
+from .embedding_store import EmbeddingStore, EmbeddingStoreWriter
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+def normalize_vectors(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.
+    return vectors / norms
+
+
+class VectorIndex(object):
+    """IVF (inverted file) index over the `code_state` vectors.
+
+    Vectors are L2-normalised and clustered with spherical k-means into `nlist`
+    cells. A query only scores the vectors stored in its `nprobe` closest cells,
+    so the cost per query grows with `nprobe / nlist` of the corpus instead of the
+    whole corpus. faiss is used when it is installed, NumPy otherwise. Scores are
+    `cosine + 1.0`, the same scale as the Elasticsearch `script_score` query.
+    """
+    def __init__(self, nlist=1024, nprobe=16, use_faiss=True):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.use_faiss = use_faiss and faiss is not None
+        self.vectors = None
+        self.code_funcs = []
+        self.identifiers = []
+        self.urls = []
+        self.centroids = None
+        self.list_ids = None      # vector ids grouped by cell
+        self.list_offsets = None  # cell c owns list_ids[list_offsets[c]: list_offsets[c + 1]]
+        self.faiss_index = None
+        self.store = None
+        self._pending = []
+
+    def __len__(self):
+        if self.vectors is None:
+            return sum(len(x) for x in self._pending)
+        return self.vectors.shape[0]
+
+    def add(self, code_states, code_funcs, file_names, code_urls):
+        if len(code_states) == 0:
+            return
+        self._pending.append(np.asarray(code_states, dtype=np.float32))
+        self.code_funcs.extend(code_funcs)
+        self.identifiers.extend(file_names)
+        self.urls.extend(code_urls)
+
+    def build(self, n_iter=10, max_train_points=256 * 1024, seed=2020):
+        if self._pending:
+            parts = ([self.vectors] if self.vectors is not None else []) + self._pending
+            self.vectors = normalize_vectors(np.concatenate(parts, axis=0))
+            self._pending = []
+        if self.vectors is None or self.vectors.shape[0] == 0:
+            raise ValueError('Cannot build an ANN index without vectors: nothing was added (empty vector_db?)')
+        num_vectors = self.vectors.shape[0]
+        # Keep at least ~39 training points per cell, as faiss recommends
+        nlist = max(1, min(self.nlist, num_vectors // 39))
+        self.nprobe = min(self.nprobe, nlist)
+        if self.use_faiss:
+            quantizer = faiss.IndexFlatIP(self.vectors.shape[1])
+            self.faiss_index = faiss.IndexIVFFlat(quantizer, self.vectors.shape[1], nlist,
+                                                  faiss.METRIC_INNER_PRODUCT)
+            self.faiss_index.train(self.vectors)
+            self.faiss_index.add(self.vectors)
+            self.faiss_index.nprobe = self.nprobe
+            return self
+        rng = np.random.RandomState(seed)
+        sample = self.vectors
+        if num_vectors > max_train_points:
+            sample = self.vectors[rng.choice(num_vectors, max_train_points, replace=False)]
+        self.centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Reseed empty cells with random training points
+                sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()), replace=False)]
+            self.centroids = normalize_vectors(sums)
+        assign = self._assign(self.vectors)
+        self.list_ids = np.argsort(assign, kind='stable').astype(np.int64)
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return self
+
+    def _assign(self, vectors, chunk_size=65536):
+        assign = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], chunk_size):
+            scores = vectors[start: start + chunk_size] @ self.centroids.T
+            assign[start: start + chunk_size] = np.argmax(scores, axis=1)
+        return assign
+
+    def search(self, query_vectors, k=10):
+        """Returns `(scores, ids)` of shape (num_queries, k); missing hits have id -1."""
+        query_vectors = normalize_vectors(np.atleast_2d(query_vectors))
+        k = min(k, len(self))
+        if self.use_faiss:
+            scores, ids = self.faiss_index.search(query_vectors, k)
+            return scores + 1.0, ids
+        all_scores = np.full((query_vectors.shape[0], k), -np.inf, dtype=np.float32)
+        all_ids = np.full((query_vectors.shape[0], k), -1, dtype=np.int64)
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        cell_scores = query_vectors @ self.centroids.T
+        for index, query in enumerate(query_vectors):
+            cells = np.argpartition(-cell_scores[index], nprobe - 1)[:nprobe]
+            candidates = np.concatenate([self.list_ids[self.list_offsets[c]: self.list_offsets[c + 1]] for c in cells])
+            if candidates.size == 0:
+                continue
+            scores = self.vectors[candidates] @ query
+            top = min(k, candidates.size)
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            all_scores[index, :top] = scores[best]
+            all_ids[index, :top] = candidates[best]
+        return all_scores + 1.0, all_ids
+
+    def get_metadata(self, i):
+        if self.store is not None:
+            return self.store.get_metadata(i)
+        return {'function': self.code_funcs[i], 'identifier': self.identifiers[i], 'url': self.urls[i]}
+
+    def save(self, dirname):
+        # The normalised vectors and their metadata are kept as a memory-mapped EmbeddingStore
+        writer = EmbeddingStoreWriter(dirname)
+        writer.add(self.vectors, self.code_funcs, self.identifiers, self.urls)
+        writer.close()
+        with open(os.path.join(dirname, 'index.json'), 'w') as f:
+            json.dump({'nlist': self.nlist, 'nprobe': self.nprobe, 'use_faiss': self.use_faiss}, f)
+        if self.use_faiss:
+            faiss.write_index(self.faiss_index, os.path.join(dirname, 'ivf.faiss'))
+        else:
+            np.save(os.path.join(dirname, 'centroids.npy'), self.centroids)
+            np.save(os.path.join(dirname, 'list_ids.npy'), self.list_ids)
+            np.save(os.path.join(dirname, 'list_offsets.npy'), self.list_offsets)
+
+    @classmethod
+    def load(cls, dirname, nprobe=None):
+        with open(os.path.join(dirname, 'index.json')) as f:
+            params = json.load(f)
+        index = cls(nlist=params['nlist'], nprobe=params['nprobe'], use_faiss=params['use_faiss'])
+        if params['use_faiss'] and faiss is None:
+            raise RuntimeError('Index at {} was built with faiss, which is not installed'.format(dirname))
+        index.store = EmbeddingStore(dirname)
+        index.vectors = index.store.vectors
+        if index.use_faiss:
+            index.faiss_index = faiss.read_index(os.path.join(dirname, 'ivf.faiss'))
+        else:
+            index.centroids = np.load(os.path.join(dirname, 'centroids.npy'))
+            index.list_ids = np.load(os.path.join(dirname, 'list_ids.npy'))
+            index.list_offsets = np.load(os.path.join(dirname, 'list_offsets.npy'))
+        if nprobe is not None:
+            index.nprobe = nprobe
+            if index.faiss_index is not None:
+                index.faiss_index.nprobe = nprobe
+        return index
@@ -2,16 +2,37 @@
 from __future__ import print_function
 import os
 import re
+import json
 import pickle
 import numpy as np
 from collections import Counter
 from functools import lru_cache
+from itertools import repeat
 
 from . import constants
+from .generic_utils import file_sha1
 
 
 word_detector = re.compile(r'\w')
 
+VOCAB_FORMAT_VERSION = 1
+VOCAB_FILE = 'vocab.json'
+WORD_EMBEDDINGS_FILE = 'word_embeddings.npy'
+
+
+def vocab_dir(saved_vocab_file):
+    """Directory of the compact form of the vocab model saved as `saved_vocab_file`."""
+    return os.path.splitext(saved_vocab_file)[0] + '.vocab'
+
+
+def vocab_source_sha1(dirname):
+    """sha1 of the pickle the compact vocab in `dirname` was converted from; None if there is none."""
+    path = os.path.join(dirname, VOCAB_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get('source_sha1')
+
 
 class VocabModel(object):
     def __init__(self, data_set, config):
@@ -46,14 +67,65 @@ class VocabModel(object):
 
         Returns:
             Vocabulary: loaded Vocabulary
+
+        The vocab is kept in the compact form of `save` in `vocab_dir(saved_vocab_file)`.
+        A pickled vocab model at `saved_vocab_file` is still read, and converted once; the
+        compact form records the pickle's sha1, so a replaced pickle is converted again.
         """
+        dirname = vocab_dir(saved_vocab_file)
         if os.path.exists(saved_vocab_file):
+            source_sha1 = file_sha1(saved_vocab_file)
+            if vocab_source_sha1(dirname) == source_sha1:
+                print('Loading pre-built vocab model stored in {}'.format(dirname))
+                return cls.load(dirname)
             print('Loading pre-built vocab model stored in {}'.format(saved_vocab_file))
             vocab_model = pickle.load(open(saved_vocab_file, 'rb'))
+            try:
+                vocab_model.save(dirname, source_sha1=source_sha1)
+                print('Converted vocab model to {}'.format(dirname))
+            except OSError as e:
+                print('Could not convert vocab model to {}: {}'.format(dirname, e))
+        elif os.path.exists(os.path.join(dirname, VOCAB_FILE)):
+            print('Loading pre-built vocab model stored in {}'.format(dirname))
+            vocab_model = cls.load(dirname)
         else:
             vocab_model = VocabModel(data_set, config)
-            print('Saving vocab model to {}'.format(saved_vocab_file))
-            pickle.dump(vocab_model, open(saved_vocab_file, 'wb'))
+            print('Saving vocab model to {}'.format(dirname))
+            vocab_model.save(dirname)
+        return vocab_model
+
+    def save(self, dirname, source_sha1=None):
+        """Writes both vocabs as JSON word lists and the word embeddings as a .npy file.
+
+        `source_sha1` is the sha1 of the pickled vocab model this is a conversion of, if any.
+        """
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        embeddings_file = os.path.join(dirname, WORD_EMBEDDINGS_FILE)
+        if self.word_vocab.embeddings is not None:
+            np.save(embeddings_file, np.asarray(self.word_vocab.embeddings))
+        elif os.path.exists(embeddings_file):
+            os.remove(embeddings_file)
+        with open(os.path.join(dirname, VOCAB_FILE), 'w') as f:
+            json.dump({'version': VOCAB_FORMAT_VERSION,
+                       'word_vocab': self.word_vocab.index2word,
+                       'edge_vocab': self.edge_vocab.index2word,
+                       'source_sha1': source_sha1}, f)
+
+    @classmethod
+    def load(cls, dirname):
+        """Reads a vocab model written by `save`. The word embeddings are memory-mapped
+        copy-on-write, so they are only read from disk as far as they are used."""
+        with open(os.path.join(dirname, VOCAB_FILE)) as f:
+            saved = json.load(f)
+        if saved['version'] != VOCAB_FORMAT_VERSION:
+            raise RuntimeError('Unsupported vocab format version {} in {}'.format(saved['version'], dirname))
+        vocab_model = cls.__new__(cls)
+        vocab_model.word_vocab = Vocab.from_words(saved['word_vocab'])
+        vocab_model.edge_vocab = Vocab.from_words(saved['edge_vocab'])
+        embeddings_file = os.path.join(dirname, WORD_EMBEDDINGS_FILE)
+        if os.path.exists(embeddings_file):
+            vocab_model.word_vocab.embeddings = np.load(embeddings_file, mmap_mode='c')
         return vocab_model
 
 
@@ -74,6 +146,15 @@ class Vocab(object):
         self.word2count = Counter()
         self.embeddings = None
 
+    @classmethod
+    def from_words(cls, index2word):
+        """Vocab whose word i is index2word[i]; index2word starts with the reserved tokens."""
+        vocab = cls()
+        assert index2word[:len(vocab.reserved)] == vocab.reserved
+        vocab.index2word = list(index2word)
+        vocab.word2index = {word: idx for idx, word in enumerate(vocab.index2word)}
+        return vocab
+
     def build_vocab(self, vocab_counter, vocab_size=None, min_freq=1):
         self.word2count = vocab_counter
         self._add_words(vocab_counter.keys())
@@ -153,6 +234,10 @@ class Vocab(object):
     def getIndex(self, word):
         return self.word2index.get(word, self.UNK)
 
+    def lookup_many(self, words):
+        """Indexes of `words` as an int64 array, UNK for unknown words."""
+        return np.fromiter(map(self.word2index.get, words, repeat(self.UNK)), dtype=np.int64, count=len(words))
+
     def getWord(self, idx):
         return self.index2word[idx] if idx < len(self.index2word) else self.unk_token
 
@@ -184,10 +269,9 @@ def collect_vocabs(all_instances):
     all_tgt_words = Counter()
     all_edge_types = Counter()
     for (sent1, sent2) in all_instances:
-        all_src_words.update(sent1.graph['backbone_sequence'])
-        all_tgt_words.update(sent2.graph['backbone_sequence'])
-        for edge in sent1.graph['edges']:
-            all_edge_types.update([edge[0]])
-        for edge in sent2.graph['edges']:
-            all_edge_types.update([edge[0]])
+        # Graph or columnar_dataset.IndexedGraph
+        all_src_words.update(sent1.sequence_words())
+        all_tgt_words.update(sent2.sequence_words())
+        all_edge_types.update(sent1.edge_type_words())
+        all_edge_types.update(sent2.edge_type_words())
     return (all_src_words, all_tgt_words, all_edge_types)
\ No newline at end of file